@@ -0,0 +1,23 @@
+# coding=utf-8
+"""Finds the App Engine SDK for Python, whose stubs and ndb loadtest.py
+and standalone.py run the demonstrator on outside App Engine."""
+import os
+import sys
+
+def find_sdk(path = None):
+	"""Returns the directory of the App Engine SDK, which contains
+	dev_appserver.py."""
+	path = path or os.environ.get('APPENGINE_SDK')
+	if path:
+		return path
+	for directory in os.environ.get('PATH', '').split(os.pathsep):
+		candidate = os.path.join(directory, 'dev_appserver.py')
+		if os.path.exists(candidate):
+			return os.path.dirname(os.path.realpath(candidate))
+	sys.exit('App Engine SDK not found, pass --sdk or set APPENGINE_SDK.')
+
+def use_sdk(path = None):
+	"""Puts the App Engine SDK and its libraries on sys.path."""
+	sys.path.insert(0, find_sdk(path))
+	import dev_appserver
+	dev_appserver.fix_sys_path()
@@ -0,0 +1,514 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Janko Hoener
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import logging
+import os
+import urllib
+import time
+import hashlib
+import backends
+from handlerlib import encode_title, retrieve_title_from_url
+from cachelib import TwoLevelCache, SingleFlight
+from answerstore import answer_store
+import upstream
+import tracelib
+from threadlib import parallel_map
+from entitylinker import get_gazetteer
+
+
+class AskNowAnswerService(object):
+	"""Answers questions with AskNow and collects information on their entities."""
+
+	GENESIS_API_URL = os.environ.get('GENESIS_API_URL', 'http://genesis.aksw.org/api/')
+	GENESIS_APIS = ['description', 'similar', 'related', 'images', 'videos']
+	GENESIS_QUERY_APIS = ['images', 'videos']
+	GENESIS_API_JSON_MAPPING = {'related': 'relatedEntities', 'similar': 'similarEntities'}
+	DBPEDIASL_URL = os.environ.get('DBPEDIASL_URL', 'http://model.dbpedia-spotlight.org/en/annotate')
+	DBPEDIA_URL = 'http://dbpedia.org/resource/'
+	DBPEDIA_API_URL = 'http://dbpedia.org/sparql'
+	DBPEDIASL_CONF = 0.4
+	GENESIS_HEADERS = {'Accept': 'application/json', 'Content-Type': 'application/json', 'Connection': 'keep-alive'}
+	GENESIS_TOTAL_DEADLINE = 2.5
+	GENESIS_RETRIES = 2
+	# What demo_answer.html shows of the Genesis results, only this is kept.
+	GENESIS_FIELDS = {'description': ['description', 'image'], 'videos': ['url', 'image', 'title', 'duration'],
+		'relatedEntities': ['url', 'image', 'title'], 'similarEntities': ['url', 'image', 'title']}
+	GENESIS_LIST_LIMIT = 12
+	GENESIS_CACHE_TTL = {'description': 86400, 'similar': 86400, 'related': 86400, 'images': 21600, 'videos': 21600}
+	genesis_cache = TwoLevelCache('genesis', maxsize = 2000, negative_ttl = 60)
+	DBPEDIASL_CACHE_TTL = 86400
+	# Entities linked with the gazetteer more confidently than this are
+	# not looked up with Spotlight.
+	GAZETTEER_MIN_CONFIDENCE = 0.5
+	spotlight_cache = TwoLevelCache('spotlight', maxsize = 5000, negative_ttl = 30)
+	spotlight_flight = SingleFlight()
+	genesis_upstream = upstream.genesis
+	# Answers are shared briefly between identical questions asked at once.
+	ANSWER_SHARE_TTL = 10
+	ANSWER_LEASE_TIMEOUT = 8
+	SHARE_ACROSS_INSTANCES = True
+	answer_cache = TwoLevelCache('answers', maxsize = 500, negative_ttl = 1)
+	answer_flight = SingleFlight()
+	spotlight_upstream = upstream.spotlight
+
+	def genesis_key(self, api):
+		return self.GENESIS_API_JSON_MAPPING.get(api, api)
+
+	def genesis_payload(self, api, title):
+		dbpurl = {}
+		if api in self.GENESIS_QUERY_APIS:
+			dbpurl['q'] = title
+		else:
+			dbpurl['url'] = self.DBPEDIA_URL + encode_title(title)
+		return json.dumps(dbpurl)
+
+	def genesis_cache_key(self, api, payload):
+		return '%s-%s' % (api, hashlib.sha1(payload).hexdigest())
+
+	def project_genesis(self, api, result):
+		# Returns the fields of result in GENESIS_FIELDS, with lists cut to
+		# GENESIS_LIST_LIMIT items.
+		if not isinstance(result, dict):
+			return result
+		key = self.genesis_key(api)
+		fields = self.GENESIS_FIELDS.get(key)
+		value = result.get(key)
+
+		def project(item):
+			if fields and isinstance(item, dict):
+				return dict((field, item[field]) for field in fields if field in item)
+			return item
+		if isinstance(value, list):
+			value = [project(item) for item in value[:self.GENESIS_LIST_LIMIT]]
+		else:
+			value = project(value)
+		return {key: value}
+
+	def genesis_section(self, api, result):
+		# Returns what the result of api adds to the information on an entity.
+		if result is None:
+			return {self.genesis_key(api): None}
+		return result
+
+	def start_genesis_round(self, pending, end, retry = False):
+		# Returns a dict from RPC to request and call for the started requests.
+		calls = {}
+		remaining = end - time.time()
+		if remaining <= 0:
+			return calls
+		deadline = min(self.genesis_upstream.deadline(), remaining)
+		for req, payload in pending.items():
+			if retry and not self.genesis_upstream.retry_allowed():
+				logging.info('Retry budget for Genesis exhausted.')
+				break
+			try:
+				call = self.genesis_upstream.make_call(self.GENESIS_API_URL + req[1], deadline,
+					span='genesis.' + req[1], retries=int(retry),
+					payload=payload, method='POST', headers=self.GENESIS_HEADERS)
+			except:
+				logging.debug('Cannot start Genesis request for %s' % (req,))
+				continue
+			if call is None:
+				logging.info('Circuit breaker for Genesis is open.')
+				break
+			calls[call.rpc] = (req, call)
+		return calls
+
+	def iter_genesis_info(self, titles, refresh = False):
+		"""Sends every title x API request at once and returns an iterator
+		over ((title, api), result) pairs in the order the results arrive.
+
+		Cached results come first, result is None if a request failed or
+		was not sent, e.g. because the circuit breaker is open. Failed
+		requests are retried in a second round after a jittered backoff,
+		also concurrently, as long as time is left of the overall deadline.
+		Only requests that were sent and failed are cached as failures.
+
+		With refresh, cached results are fetched again and only replaced by
+		successful results.
+		"""
+		end = time.time() + self.GENESIS_TOTAL_DEADLINE
+		pending = {}
+		for title in titles:
+			for api in self.GENESIS_APIS:
+				pending[(title, api)] = self.genesis_payload(api, title)
+		cachekeys = dict((req, self.genesis_cache_key(req[1], payload)) for req, payload in pending.items())
+		cached = self.genesis_cache.get_multi(cachekeys.values()) if not refresh else {}
+		ready = []
+		for req, cachekey in cachekeys.items():
+			if cachekey in cached:
+				ready.append((req, cached[cachekey]))
+				del pending[req]
+		logging.info('%s Genesis results served from cache.' % len(ready))
+		calls = self.start_genesis_round(pending, end)
+		return self.collect_genesis_info(ready, pending, calls, cachekeys, end, refresh)
+
+	def collect_genesis_info(self, ready, pending, calls, cachekeys, end, refresh = False):
+		fetched = {}
+		failed = set()
+		try:
+			for req, result in ready:
+				yield req, result
+			retry = self.GENESIS_RETRIES - 1
+			while calls:
+				rpc = backends.fetch.wait_any(calls.keys())
+				req, call = calls.pop(rpc)
+				urlobj = call.get_result()
+				result = None
+				if urlobj is not None and urlobj.status_code == 200:
+					try:
+						result = self.project_genesis(req[1], json.loads(urlobj.content))
+					except ValueError:
+						pass
+				if result is None:
+					failed.add(req)
+				else:
+					fetched[req] = result
+					del pending[req]
+					yield req, result
+				if not calls and pending and retry:
+					self.genesis_upstream.sleep_before_retry(self.GENESIS_RETRIES - retry, end)
+					retry = retry - 1
+					calls = self.start_genesis_round(pending, end, retry = True)
+			if pending:
+				logging.info('%s Genesis requests failed or were not sent.' % len(pending))
+			# Failures are only known once all requests have been waited for.
+			for req in pending.keys():
+				if req in failed:
+					fetched[req] = None
+				yield req, None
+		finally:
+			# Never cache a failure over a result that is being refreshed.
+			for api in self.GENESIS_APIS:
+				values = dict((cachekeys[req], value) for req, value in fetched.items()
+					if req[1] == api and (value is not None or not refresh))
+				if values:
+					self.genesis_cache.set_multi(values, self.GENESIS_CACHE_TTL[api])
+
+	def split_titles(self, titles):
+		# Returns the answers to show and the titles of the entities among titles.
+		answers = []
+		entities = []
+		for title in titles:
+			title_type = type(title)
+			if title_type is int or title_type is float:
+				answers.append("{:,}".format(title))
+				titles.remove(title)
+				continue
+			elif title_type is bool:
+				answers.append(('Yes', 'No')[title])
+				titles.remove(title)
+				continue
+			elif title_type is not str:
+				raise ValueError('title must be string, int, float or boolean')
+			# elif title_type is str:
+			entities.append(title)
+		answers.extend(titles)
+		return answers, entities
+
+	def iter_information(self, entities):
+		"""Starts retrieving information on entities and returns an iterator
+		over the information dict of every entity, in order.
+
+		Each dict is yielded as soon as all of its Genesis sections arrived.
+		The iterator is read while the response is sent, so if retrieving
+		fails, the remaining dicts only hold the title and an error.
+		"""
+		positions = {}
+		for i, title in enumerate(entities):
+			positions.setdefault(title, []).append(i)
+		sections = [{} for title in entities]
+		parts = self.iter_genesis_info(entities)
+
+		def generate():
+			next_index = 0
+			try:
+				for (title, api), result in parts:
+					for i in positions[title]:
+						sections[i][api] = result
+					while next_index < len(entities) and len(sections[next_index]) == len(self.GENESIS_APIS):
+						cur_info = {}
+						cur_info['title'] = entities[next_index]
+						for api in self.GENESIS_APIS:
+							cur_info.update(self.genesis_section(api, sections[next_index][api]))
+						yield cur_info
+						next_index = next_index + 1
+			except Exception:
+				logging.exception('Cannot retrieve information on %s' % entities[next_index:])
+				for title in entities[next_index:]:
+					yield { 'title': title, 'error': 'Cannot retrieve information from Genesis.' }
+		return generate()
+
+	def fetch_entities(self, phrase):
+		# Returns None if DBpedia Spotlight could not be reached.
+		param = {}
+		param['text'] = phrase
+		param['confidence'] = self.DBPEDIASL_CONF
+		url = self.DBPEDIASL_URL + '?' + urllib.urlencode(param)
+		logging.info('Retrieving entities for %s from %s' % (phrase, url))
+		headers = { 'Accept' : 'application/json' }
+		a = self.spotlight_upstream.fetch(url, headers = headers)
+		if a is None or a.status_code != 200:
+			return None
+		entityobj = json.loads(a.content)
+		logging.debug(entityobj)
+		if entityobj.get('Resources'):
+			titles = []
+			for entity in entityobj['Resources']:
+				if entity.get('@URI'):
+					title = retrieve_title_from_url(entity['@URI']).encode('utf-8')
+					titles.append(title)
+			if titles:
+				logging.info('Successfully retrieved entities for %s' % phrase)
+				return titles
+			else:
+				return []
+		else:
+			return []
+
+	def normalize_phrase(self, phrase):
+		return ' '.join(phrase.lower().split()).strip('?!.,; ')
+
+	def retrieve_cached_entities(self, phrase, cachekey):
+		hit, titles = self.spotlight_cache.get(cachekey)
+		if hit:
+			logging.info('Entities for %s served from cache.' % phrase)
+			return titles
+		titles = self.fetch_entities(phrase)
+		self.spotlight_cache.set(cachekey, titles, self.DBPEDIASL_CACHE_TTL)
+		return titles
+
+	def link_locally(self, phrase):
+		# Returns the titles of the entities in phrase found by the
+		# gazetteer, or None if it is not confident about them.
+		gazetteer = get_gazetteer()
+		if gazetteer is None:
+			return None
+		with tracelib.span('link_locally'):
+			titles = gazetteer.link_confidently(phrase, self.GAZETTEER_MIN_CONFIDENCE)
+		if titles is None:
+			return None
+		logging.info('Entities for %s linked locally.' % phrase)
+		return [title.encode('utf-8') for title in titles]
+
+	def entities_cache_key(self, phrase):
+		return hashlib.sha1('%s|%s' % (self.DBPEDIASL_CONF, phrase)).hexdigest()
+
+	def retrieve_entities(self, phrase):
+		phrase = self.normalize_phrase(phrase)
+		cachekey = self.entities_cache_key(phrase)
+		with tracelib.span('retrieve_entities'):
+			titles = self.link_locally(phrase)
+			if titles is None:
+				titles = self.spotlight_flight.do(cachekey, self.retrieve_cached_entities, phrase, cachekey)
+		return list(titles or [])
+	
+	def retrieve_titles(self, question):
+		# FIXME: this should use a call to an AskNow API
+		with tracelib.span('retrieve_titles'):
+			return answer_store.lookup(question)
+
+	def normalize_question(self, query):
+		question = query.lower().replace('?', '')
+		return question.encode('utf-8')
+
+	def retrieve_answer_head(self, query):
+		"""Returns the answer dict for query without information on entities,
+		and the titles of the entities of the answers.
+
+		The titles are None if they have to be retrieved from the question.
+		"""
+		question = self.normalize_question(query)
+		answers = {}
+		entities = []
+		if query:
+			logging.info('Retrieving titles for question %s' % question)
+			titles = self.retrieve_titles(question)
+			logging.info('Retrieved %s titles.' % len(titles))
+			if len(titles) > 0:
+				logging.info('Question answered by AskNow.')
+				answers['answers'], entities = self.split_titles(titles)
+				answers['answered'] = True
+				if len(entities) == 0 and len(answers['answers']) > 0:
+					logging.info('Question answered, but no information on entities available.' +
+						'Loading info for entities of question.')
+					entities = None
+			else:
+				logging.info('Question cannot be answered by AskNow.' +
+					'Attempting to load entities of the question.')
+				answers['answers'] = []
+				answers['answered'] = False
+				entities = None
+			answers['lenanswers'] = len(answers['answers'])
+			answers['status'] = 0
+			answers['message'] = 'Connection successful.'
+		else:
+			answers = { 'status': 2, 'message': 'Application needs a q parameter, none given.' }
+		answers['question'] = query
+		return answers, entities
+
+	def answer_lazily(self, query):
+		"""Returns the answer dict for query, with an iterator over the
+		information on its entities that is filled as the results arrive."""
+		answers, entities = self.retrieve_answer_head(query)
+		if 'answered' in answers:
+			if entities is None:
+				entities = self.retrieve_entities(self.normalize_question(query))
+			answers['leninfo'] = len(entities)
+			answers['information'] = self.iter_information(entities)
+		return answers
+
+	def answer(self, query):
+		"""Returns the answer dict served by /asknow/json for query."""
+		answers = self.answer_lazily(query)
+		if 'information' in answers:
+			with tracelib.span('retrieve_info'):
+				answers['information'] = list(answers['information'])
+			logging.info('Information successfully retrieved.')
+		return answers
+
+	def answer_shared(self, query, key):
+		# Only one instance answers a question at a time, the others wait
+		# for its answer as long as it holds the lease in the shared cache.
+		hit, answers = self.answer_cache.get(key)
+		if hit and answers is not None:
+			return answers
+		if not self.SHARE_ACROSS_INSTANCES:
+			answers = self.answer(query)
+			self.answer_cache.set(key, answers, self.ANSWER_SHARE_TTL)
+			return answers
+		leasekey = 'lease-' + key
+		if backends.cache.add(leasekey, 1, time = self.ANSWER_LEASE_TIMEOUT, namespace = 'answers'):
+			try:
+				answers = self.answer(query)
+				self.answer_cache.set(key, answers, self.ANSWER_SHARE_TTL)
+			finally:
+				backends.cache.delete(leasekey, namespace = 'answers')
+			return answers
+		logging.info('Question %s is being answered by another instance, waiting.' % query)
+		end = time.time() + self.ANSWER_LEASE_TIMEOUT
+		wait = 0.05
+		while time.time() < end:
+			time.sleep(wait)
+			wait = min(wait * 2, 0.5)
+			answers = backends.cache.get(key, namespace = 'answers')
+			if answers is not None:
+				return answers
+			if backends.cache.get(leasekey, namespace = 'answers') is None:
+				break
+		logging.info('No answer from another instance for %s, answering.' % query)
+		return self.answer(query)
+
+	def answer_coalesced(self, query):
+		"""Returns a copy of the answer dict for query.
+
+		Concurrent requests for the same question share the work of the
+		first one, within this instance and across instances. Only case and
+		whitespace may differ between them, other wordings may link other
+		entities.
+		"""
+		if not query:
+			return self.answer(query)
+		question = ' '.join(query.lower().split())
+		if isinstance(question, unicode):
+			question = question.encode('utf-8')
+		key = hashlib.sha1(question).hexdigest()
+		answers = dict(self.answer_flight.do(key, self.answer_shared, query, key))
+		answers['question'] = query
+		return answers
+
+	def answer_progressive(self, query):
+		"""Yields the parts of the answer for query as they become available.
+
+		The answer block comes first, followed by the titles of the entities,
+		one information part per Genesis section of every entity in the order
+		they arrive, and a final done part. The parts are read while the
+		response is sent, so a failure ends them with an error part instead.
+		"""
+		try:
+			answers, entities = self.retrieve_answer_head(query)
+			answers['type'] = 'answer'
+			yield answers
+			if 'answered' not in answers:
+				return
+			if entities is None:
+				entities = self.retrieve_entities(self.normalize_question(query))
+			yield { 'type': 'entities', 'titles': entities, 'leninfo': len(entities) }
+			positions = {}
+			for i, title in enumerate(entities):
+				positions.setdefault(title, []).append(i)
+			for (title, api), result in self.iter_genesis_info(entities):
+				for i in positions[title]:
+					yield { 'type': 'information', 'index': i, 'title': title, 'section': api,
+						'data': self.genesis_section(api, result) }
+		except Exception:
+			logging.exception('Cannot answer question %s progressively' % query)
+			yield { 'type': 'error', 'status': 2, 'message': 'Cannot answer question with AskNow.', 'question': query }
+			return
+		yield { 'type': 'done', 'question': query }
+
+	def refresh_entities(self, phrase):
+		# Fetches the entities of phrase again. If that fails, the cached
+		# entities are kept and returned.
+		phrase = self.normalize_phrase(phrase)
+		titles = self.link_locally(phrase)
+		if titles is not None:
+			return titles
+		titles = self.fetch_entities(phrase)
+		if titles is None:
+			return self.retrieve_entities(phrase)
+		self.spotlight_cache.set(self.entities_cache_key(phrase), titles, self.DBPEDIASL_CACHE_TTL)
+		return list(titles)
+
+	def refresh_question(self, query):
+		# Returns the titles of the entities of the answer to query.
+		answers, entities = self.retrieve_answer_head(query)
+		if 'answered' not in answers:
+			return []
+		if entities is None:
+			entities = self.refresh_entities(self.normalize_question(query))
+		return entities
+
+	def refresh_information(self, titles):
+		# Returns the number of Genesis results retrieved for titles.
+		return len([req for req, result in self.iter_genesis_info(titles, refresh = True) if result is not None])
+
+	def warm_up(self, queries, max_workers = 5, titles_per_worker = 5):
+		"""Fetches the entities of queries and the information on them
+		again, and writes them to the caches.
+
+		Returns the number of entities and of Genesis results retrieved.
+		"""
+		titles = set()
+		for entities in parallel_map(self.refresh_question, queries, max_workers):
+			titles.update(entities or [])
+		titles = sorted(titles)
+		chunks = [titles[i:i + titles_per_worker] for i in range(0, len(titles), titles_per_worker)]
+		results = sum(n or 0 for n in parallel_map(self.refresh_information, chunks, max_workers))
+		return len(titles), results
+
+def decode_strings(obj):
+	"""Decodes all UTF-8 byte strings in obj, as a JSON round trip would."""
+	if isinstance(obj, str):
+		return obj.decode('utf-8')
+	elif isinstance(obj, dict):
+		return dict((decode_strings(k), decode_strings(v)) for k, v in obj.items())
+	elif isinstance(obj, list):
+		return [decode_strings(x) for x in obj]
+	return obj
+
+answer_service = AskNowAnswerService()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Janko Hoener
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+
+ANSWERS_PATH = os.environ.get('ANSWERS_PATH',
+	os.path.join(os.path.dirname(__file__), 'data', 'answers.jsonl'))
+STOPWORDS = frozenset([u'a', u'an', u'the', u'please'])
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+def normalize_question(question):
+	"""Returns the canonical form of question used as key in the store.
+
+	Case, accents, punctuation, whitespace and stopwords are ignored.
+	"""
+	if isinstance(question, str):
+		question = question.decode('utf-8', 'replace')
+	question = unicodedata.normalize('NFKD', question.lower())
+	question = u''.join(c for c in question if not unicodedata.combining(c))
+	tokens = TOKEN_RE.findall(question)
+	return u' '.join(t for t in tokens if t not in STOPWORDS).encode('utf-8')
+
+def encode_answer(answer):
+	# The answer service expects titles as UTF-8 byte strings.
+	if isinstance(answer, unicode):
+		return answer.encode('utf-8')
+	return answer
+
+class AnswerStore(object):
+	"""Answers to known questions, indexed by their normalized form.
+
+	The store is read from a file with one JSON object per line, e.g.
+	{"question": "in which city was beethoven born", "answers": ["Bonn"]}.
+	The file is checked for changes every RELOAD_INTERVAL seconds and
+	reloaded by the next lookup, so it can be updated without a redeploy.
+	"""
+	RELOAD_INTERVAL = 60
+
+	def __init__(self, path = ANSWERS_PATH):
+		self.path = path
+		self.index = {}
+		self.mtime = None
+		self.checked = 0
+		self.lock = threading.Lock()
+		self.reload()
+
+	def load(self):
+		index = {}
+		with open(self.path) as f:
+			for line in f:
+				line = line.strip()
+				if not line:
+					continue
+				try:
+					entry = json.loads(line)
+				except ValueError:
+					logging.warning('Skipping malformed line in %s' % self.path)
+					continue
+				key = normalize_question(entry['question'])
+				index[key] = tuple(encode_answer(a) for a in entry['answers'])
+		return index
+
+	def reload(self):
+		"""Reads the file if it changed since it was last read."""
+		self.checked = time.time()
+		try:
+			mtime = os.path.getmtime(self.path)
+		except OSError:
+			logging.warning('Answer store %s does not exist' % self.path)
+			return
+		if mtime == self.mtime:
+			return
+		index = self.load()
+		# Swap in the new index at once, lookups never see a partial one.
+		self.index = index
+		self.mtime = mtime
+		logging.info('Loaded %s answers from %s' % (len(index), self.path))
+
+	def maybe_reload(self):
+		if time.time() - self.checked < self.RELOAD_INTERVAL:
+			return
+		if self.lock.acquire(False):
+			try:
+				self.reload()
+			except Exception:
+				logging.exception('Cannot reload answer store %s' % self.path)
+			finally:
+				self.lock.release()
+
+	def lookup(self, question):
+		"""Returns a new list with the answers to question, empty if unknown."""
+		self.maybe_reload()
+		return list(self.index.get(normalize_question(question), ()))
+
+	def __len__(self):
+		return len(self.index)
+
+answer_store = AnswerStore()
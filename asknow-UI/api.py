@@ -15,11 +15,17 @@
 
 
 import json
-from google.appengine.api import memcache, urlfetch, urlfetch_errors
 import logging
 from handlerlib import *
 from datatypes import *
 from userauth import *
+from answerlib import answer_service
+from threadlib import imap_unordered
+import backends
+import tracelib
+import upstream
+from relationlinker import get_relation_index
+from propertymap import property_mapping
 import urllib, urllib2
 from urllib2 import Request
 import os
@@ -27,163 +33,147 @@ from google.appengine.api.urlfetch_errors import *
 
 
 class AskNowJSONAnswerHandler(Handler):
-	GENESIS_API_URL = 'http://genesis.aksw.org/api/'
-	GENESIS_APIS = ['description', 'similar', 'related', 'images', 'videos']
-	GENESIS_QUERY_APIS = ['images', 'videos']
-	GENESIS_API_JSON_MAPPING = {'related': 'relatedEntities', 'similar': 'similarEntities'}
-	DBPEDIASL_URL = 'http://model.dbpedia-spotlight.org/en/annotate'
-	DBPEDIA_URL = 'http://dbpedia.org/resource/'
-	DBPEDIA_API_URL = 'http://dbpedia.org/sparql'
-	DBPEDIASL_CONF = 0.4
-
-	def retrieve_info(self, titles):
-		resp = {}
-		resp['information'] = []
-		resp['answers'] = []
-		for title in titles:
-			title_type = type(title)
-			if title_type is int or title_type is float:
-				resp['answers'].append("{:,}".format(title))
-				titles.remove(title)
-				continue
-			elif title_type is bool:
-				resp['answers'].append(('Yes', 'No')[title])
-				titles.remove(title)
-				continue
-			elif title_type is not str:
-				raise ValueError('title must be string, int, float or boolean')
-			# elif title_type is str:
-			cur_info = {}
-			cur_info['title'] = title
-			for api in self.GENESIS_APIS:
-				dbpurl = {}
-				if api in self.GENESIS_QUERY_APIS:
-					dbpurl['q'] = title
-				else:
-					dbpurl['url'] = self.DBPEDIA_URL + self.encode_title(title)
-				dbpjson = json.dumps(dbpurl)
-				url = self.GENESIS_API_URL + api
-				retry = 2
-				while retry:
-					try:
-						urlobj = urlfetch.fetch(url, method='POST', payload=dbpjson, headers={'Accept': 'application/json', 'Content-Type': 'application/json', 'Connection': 'keep-alive'}, deadline=1)
-					except:
-						retry = retry - 1
-						if not retry:
-							if api in self.GENESIS_API_JSON_MAPPING:
-								cur_info[self.GENESIS_API_JSON_MAPPING[api]] = None
-							else:
-								cur_info[api] = None
-							break
-					else:
-						if urlobj.status_code == 200:
-							cur_info.update(json.loads(urlobj.content))
-							break
-						else:
-							retry = retry - 1
-							if not retry:
-								if api in self.GENESIS_API_JSON_MAPPING:
-									answer[self.GENESIS_API_JSON_MAPPING[api]] = None
-								else:
-									answer[api] = None
-								break
-			resp['information'].append(cur_info)
-		resp['answers'].extend(titles)
-		resp['lenanswers'] = len(resp['answers'])
-		resp['status'] = 0
-		resp['message'] = 'Connection successful.'
-		return resp
-		
-	def retrieve_entities(self, phrase):
-		param = {}
-		param['text'] = phrase
-		param['confidence'] = self.DBPEDIASL_CONF
-		params = 'text=%s&confidence=%s' % (param['text'], param['confidence'])
-		url = self.DBPEDIASL_URL + '?' + urllib.urlencode(param)
-		logging.info('Retrieving entities for %s from %s' % (phrase, url))
-		headers = { 'Accept' : 'application/json' }
-		retry = 2
-		while retry:
-			try:
-				a = urlfetch.fetch(url, headers = headers)
-			except:
-				retry = retry - 1
-				if not retry:
-					return []
-			else:
-				if a.status_code == 200:
-					entityobj = json.loads(a.content)
-					logging.debug(entityobj)
-					if entityobj.get('Resources'):
-						titles = []
-						for entity in entityobj['Resources']:
-							if entity.get('@URI'):
-								title = self.retrieve_title_from_url(entity['@URI']).encode('utf-8')
-								titles.append(title)
-						if titles:
-							logging.info('Successfully retrieved entities for %s' % phrase)
-							return titles
-						else:
-							return []
-					else:
-						return []
-				else:
-					return []
-	
-	def retrieve_titles(self, question):
-		# FIXME: this should use a call to an AskNow API
-		known_answers = {
-			'how many symphonies did beethoven compose': [9],
-			'how many inhabitants does oberhausen have': [210934],
-			'is albert einstein alive': [True],
-			'is kanye west alive': [False],
-			'who is the president of the united states': ['Barack Obama'],
-			'how many goals did gerd müller score': ['Gerd Müller'],
-			'who is the president elect of the united states': ['Donald Trump'],
-			'in which city was beethoven born': ['Bonn'],
-			'in which city was adenauer born': ['Cologne'],
-			'what country is shah rukh khan from': ['India'],
-			'what are the capitals of germany and india': ['Berlin', 'New Delhi'],
-			'what are the capitals of germany, india and usa': ['Berlin', 'New Delhi', 'Washington D.C.'],
-			'what are the capitals of germany, india, usa and france': ['Berlin', 'New Delhi', 'Washington D.C.', 'Paris']
-		}
-		if question in known_answers:
-			return known_answers[question]
-		else:
-			return []
-
 	def get(self):
-		query = question = self.request.get('q')
+		query = self.request.get('q')
 		logging.info('Generating JSON for query %s' % query)
-		question = question.lower().replace('?', '')
-		question = question.encode('utf-8')
-		answers = {}
-		if query:
-			logging.info('Retrieving titles for question %s' % question)
-			titles = self.retrieve_titles(question)
-			logging.info('Retrieved %s titles.' % len(titles))
-			if len(titles) > 0:
-				logging.info('Question answered by AskNow, retrieving info for titles.')
-				answers = self.retrieve_info(titles)
-				answers['answered'] = True
-				if len(answers['information']) == 0 and answers.get('lenanswers') > 0:
-					logging.info('Question answered, but no information on entities available.' +
-						'Loading info for entities of question.')
-					entitytitles = self.retrieve_entities(question)
-					entityanswers = self.retrieve_info(entitytitles)
-					answers['information'].extend(entityanswers['information'])
-				logging.info('Information successfully retrieved.')
-			else:
-				logging.info('Question cannot be answered by AskNow.' +
-					'Attempting to load entities of the question.')
-				titles = self.retrieve_entities(question)
-				answers = self.retrieve_info(titles)
-				answers['answers'] = []
-				answers['lenanswers'] = 0
-				answers['answered'] = False
+		if self.request.get('stream'):
+			# Progressive mode: one NDJSON line per part of the answer.
+			self.response.headers['Content-Type'] = 'application/x-ndjson; charset=UTF-8'
+			parts = answer_service.answer_progressive(query)
+			self.response.app_iter = (json.dumps(part) + '\n' for part in parts)
+			return
+		answers = answer_service.answer_coalesced(query)
+		json_string = json.dumps(answers, separators = (',', ':'), sort_keys = True)
+		self.write_cacheable(json_string, 'application/json; charset=UTF-8')
+
+class AskNowBatchAnswerHandler(Handler):
+	"""Answers a list of questions, one NDJSON line per answer in the order
+	the answers are ready.
+
+	The lines are only sent as they are ready under standalone.py. The
+	python27 runtime of App Engine buffers the whole response.
+	"""
+	MAX_QUESTIONS = 100
+	MAX_WORKERS = 5
+
+	def read_questions(self):
+		content_type = self.request.content_type
+		if content_type == 'application/json':
+			data = json.loads(self.request.body)
+			if isinstance(data, dict):
+				data = data.get('questions', [])
+			if not isinstance(data, list) or not all(isinstance(q, basestring) for q in data):
+				raise ValueError('questions must be a list of strings')
+			return [q for q in data if q]
+		elif content_type == 'application/x-www-form-urlencoded':
+			return [q for q in self.request.get_all('q') if q]
 		else:
-			answers = { 'status': 2, 'message': 'Application needs a q parameter, none given.' }
-		answers['question'] = query
-		json_string = json.dumps(answers)
+			lines = self.request.body.decode('utf-8').splitlines()
+			return [line.strip() for line in lines if line.strip()]
+
+	def answer_line(self, item):
+		index, question = item
+		try:
+			answers = answer_service.answer_coalesced(question)
+		except Exception:
+			logging.exception('Cannot answer question %s' % question)
+			answers = { 'status': 2, 'message': 'Cannot answer question.', 'question': question }
+		answers['index'] = index
+		return json.dumps(answers) + '\n'
+
+	def post(self):
+		try:
+			questions = self.read_questions()
+		except (ValueError, TypeError, UnicodeDecodeError):
+			questions = None
+		self.response.headers['Content-Type'] = 'application/json; charset=UTF-8'
+		if not questions:
+			self.response.set_status(400)
+			self.write(json.dumps({ 'status': 2, 'message': 'Application needs a list of questions, none given.' }))
+			return
+		if len(questions) > self.MAX_QUESTIONS:
+			self.response.set_status(400)
+			self.write(json.dumps({ 'status': 3, 'message': 'At most %s questions can be asked at once.' % self.MAX_QUESTIONS }))
+			return
+		logging.info('Answering batch of %s questions' % len(questions))
+		self.response.headers['Content-Type'] = 'application/x-ndjson; charset=UTF-8'
+		self.response.app_iter = imap_unordered(self.answer_line, enumerate(questions), self.MAX_WORKERS)
+
+class AskNowRelationsHandler(Handler):
+	"""Links phrases to Wikidata properties.
+
+	GET takes the phrases as q parameters, POST also as a JSON list or as
+	{"phrases": [...], "k": 5}. The top k properties of every phrase are
+	returned with their labels, scores, matches and equivalent DBpedia
+	properties. The match tells the scale of the score: "bm25" for an
+	unbounded BM25 score of the words of the phrase, "fuzzy" for the
+	similarity from 0 to 1 of a label to a phrase with typos. The lists of
+	DBpedia properties are empty until data/property_mapping.tsv
+	is written with link_wikidata_asknow.py.
+	"""
+	MAX_PHRASES = 100
+	DEFAULT_K = 5
+	MAX_K = 50
+	MAX_AGE = 3600
+
+	def read_phrases(self):
+		if self.request.method == 'POST' and self.request.content_type == 'application/json':
+			data = json.loads(self.request.body)
+			k = None
+			if isinstance(data, dict):
+				data, k = data.get('phrases', []), data.get('k')
+			if not isinstance(data, list) or not all(isinstance(p, basestring) for p in data):
+				raise ValueError('phrases must be a list of strings')
+			return [p for p in data if p], k
+		return [p for p in self.request.get_all('q') if p], self.request.get('k') or None
+
+	def link(self, phrase, k):
+		index = get_relation_index()
+		relations = []
+		for pid, score, match in index.link(phrase, k):
+			relations.append({'pid': pid, 'label': index.label(pid), 'score': round(score, 4), 'match': match,
+				'dbpedia': property_mapping.to_dbpedia(pid)})
+		return {'phrase': phrase, 'relations': relations}
+
+	def get(self):
+		try:
+			phrases, k = self.read_phrases()
+			k = int(k or self.DEFAULT_K)
+		except (ValueError, TypeError, AttributeError):
+			phrases, k = None, None
+		self.response.headers['Content-Type'] = 'application/json; charset=UTF-8'
+		if not phrases:
+			self.response.set_status(400)
+			self.write(json.dumps({ 'status': 2, 'message': 'Application needs a q parameter, none given.' }))
+			return
+		if len(phrases) > self.MAX_PHRASES or not 0 < k <= self.MAX_K:
+			self.response.set_status(400)
+			self.write(json.dumps({ 'status': 3, 'message': 'At most %s phrases and %s relations per phrase can be linked at once.' %
+				(self.MAX_PHRASES, self.MAX_K) }))
+			return
+		with tracelib.span('link_relations'):
+			results = [self.link(phrase, k) for phrase in phrases]
+		# The results only change with the index, so they can be cached.
+		if self.request.method == 'GET':
+			self.response.headers['Cache-Control'] = 'public, max-age=%s' % self.MAX_AGE
+		self.write_cacheable(json.dumps({ 'status': 0, 'k': k, 'results': results }, separators = (',', ':'), sort_keys = True),
+			'application/json; charset=UTF-8')
+
+	def post(self):
+		self.get()
+
+class AskNowStatsHandler(Handler):
+	# Latency histograms, upstream and cache statistics of this instance.
+	def get(self):
+		stats = {}
+		stats['latency'] = tracelib.histogram_stats()
+		stats['upstreams'] = dict((u.name, u.stats()) for u in (upstream.genesis, upstream.spotlight, upstream.asknow))
+		stats['caches'] = {
+			'genesis': answer_service.genesis_cache.stats(),
+			'spotlight': answer_service.spotlight_cache.stats(),
+			'answers': answer_service.answer_cache.stats(),
+		}
+		stats['backends'] = dict((name, type(backend).__name__)
+			for name, backend in (('cache', backends.cache), ('fetch', backends.fetch), ('storage', backends.storage)))
 		self.response.headers['Content-Type'] = 'application/json; charset=UTF-8'
-		self.write(json_string)
\ No newline at end of file
+		self.write(json.dumps(stats, indent = 2, sort_keys = True))
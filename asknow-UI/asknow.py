@@ -17,11 +17,16 @@
 from userauth import *
 from api import *
 from demo import *
+from tasks import AskNowWarmUpHandler
 
 ASKNOW_PATH = '/asknow/'
 app = webapp2.WSGIApplication([
 		webapp2.Route(ASKNOW_PATH + 'demo', handler = AskNowDemoHandler, name = 'demo'),
 		(ASKNOW_PATH + 'json', AskNowJSONAnswerHandler),
+		(ASKNOW_PATH + 'batch', AskNowBatchAnswerHandler),
+		(ASKNOW_PATH + 'relations', AskNowRelationsHandler),
+		(ASKNOW_PATH + 'stats', AskNowStatsHandler),
+		(ASKNOW_PATH + 'tasks/warmup', AskNowWarmUpHandler),
 		(ASKNOW_PATH + 'signup', AskNowSignUpHandler),
 		(ASKNOW_PATH + 'login', AskNowLoginHandler),
 		(ASKNOW_PATH + 'logout', AskNowLogoutHandler),
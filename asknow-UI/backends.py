@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Janko Hoener
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""The services the demonstrator runs on: the cache, HTTP fetches and the
+storage of users and questions.
+
+On App Engine they are memcache, urlfetch and ndb on the datastore.
+Elsewhere, e.g. when run by standalone.py, they are chosen by the
+environment:
+  ASKNOW_CACHE    appengine, memory, or memcached on MEMCACHED_SERVERS
+  ASKNOW_FETCH    appengine, or threads
+  ASKNOW_STORAGE  appengine, local in the file ASKNOW_DATASTORE_PATH, or
+                  cloud on Cloud Datastore of DATASTORE_PROJECT_ID (or its
+                  emulator at DATASTORE_EMULATOR_HOST)
+The models stay ndb models, so outside App Engine ndb is taken from the
+App Engine SDK.
+"""
+import collections
+import cPickle
+import hashlib
+import httplib
+import os
+import Queue
+import socket
+import threading
+import time
+import urlparse
+
+DATASTORE_PATH = os.environ.get('ASKNOW_DATASTORE_PATH',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'datastore.sqlite'))
+LOCAL_APP_ID = 'dev~asknow'
+
+def expiry(seconds):
+	# The time an entry stored for seconds expires at, 0 for never.
+	return time.time() + seconds if seconds else 0
+
+class AppEngineCache(object):
+	"""memcache of App Engine."""
+	def __init__(self):
+		from google.appengine.api import memcache
+		self.memcache = memcache
+
+	def get(self, key, namespace = None):
+		return self.memcache.get(key, namespace = namespace)
+
+	def get_multi(self, keys, namespace = None):
+		return self.memcache.get_multi(keys, namespace = namespace)
+
+	def set(self, key, value, time = 0, namespace = None):
+		return self.memcache.set(key, value, time = time, namespace = namespace)
+
+	def set_multi(self, mapping, time = 0, namespace = None):
+		return self.memcache.set_multi(mapping, time = time, namespace = namespace)
+
+	def add(self, key, value, time = 0, namespace = None):
+		return self.memcache.add(key, value, time = time, namespace = namespace)
+
+	def delete(self, key, namespace = None):
+		return self.memcache.delete(key, namespace = namespace)
+
+class MemoryCache(object):
+	"""A bounded LRU cache in the memory of this process, with the interface
+	of memcache.
+
+	Values are pickled like memcache does, so callers get copies they may
+	change. The cache is not shared, use memcached for several processes.
+	"""
+	def __init__(self, maxsize = 100000):
+		self.maxsize = maxsize
+		self.lock = threading.Lock()
+		self.entries = collections.OrderedDict() # (namespace, key) -> (pickled value, expiry)
+
+	def lookup(self, entry_key, now = None):
+		# Returns the pickled value of entry_key, the lock must be held.
+		now = now or time.time()
+		entry = self.entries.pop(entry_key, None)
+		if entry is None:
+			return None
+		if entry[1] and entry[1] < now:
+			return None
+		self.entries[entry_key] = entry
+		return entry[0]
+
+	def store(self, entry_key, data, expires):
+		# The lock must be held.
+		self.entries.pop(entry_key, None)
+		self.entries[entry_key] = (data, expires)
+		while len(self.entries) > self.maxsize:
+			self.entries.popitem(last = False)
+
+	def get_multi(self, keys, namespace = None):
+		now = time.time()
+		found = {}
+		with self.lock:
+			for key in keys:
+				data = self.lookup((namespace, key), now)
+				if data is not None:
+					found[key] = data
+		return dict((key, cPickle.loads(data)) for key, data in found.items())
+
+	def get(self, key, namespace = None):
+		return self.get_multi([key], namespace).get(key)
+
+	def set_multi(self, mapping, time = 0, namespace = None):
+		"""Stores mapping, returns the keys not stored like memcache."""
+		expires = expiry(time)
+		pickled = [(key, cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)) for key, value in mapping.items()]
+		with self.lock:
+			for key, data in pickled:
+				self.store((namespace, key), data, expires)
+		return []
+
+	def set(self, key, value, time = 0, namespace = None):
+		return not self.set_multi({key: value}, time, namespace)
+
+	def add(self, key, value, time = 0, namespace = None):
+		"""Stores value only if key is not cached, returns whether it did."""
+		data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+		with self.lock:
+			if self.lookup((namespace, key)) is not None:
+				return False
+			self.store((namespace, key), data, expiry(time))
+		return True
+
+	def delete(self, key, namespace = None):
+		with self.lock:
+			self.entries.pop((namespace, key), None)
+
+	def __len__(self):
+		return len(self.entries)
+
+class MemcachedCache(object):
+	"""memcached servers shared by processes and hosts, through the
+	python-memcached client, which keeps a connection per thread.
+
+	Namespaces are key prefixes. Keys memcached does not take, e.g. long
+	or with spaces, are hashed.
+	"""
+	MAX_KEY_LENGTH = 250
+
+	def __init__(self, servers):
+		import memcache
+		self.client = memcache.Client(servers)
+
+	def server_key(self, key, namespace):
+		if isinstance(key, unicode):
+			key = key.encode('utf-8')
+		key = '%s:%s' % (namespace or '', key)
+		if len(key) > self.MAX_KEY_LENGTH or any(c <= ' ' or c == '\x7f' for c in key):
+			key = 'sha1:' + hashlib.sha1(key).hexdigest()
+		return key
+
+	def get_multi(self, keys, namespace = None):
+		server_keys = dict((self.server_key(key, namespace), key) for key in keys)
+		found = self.client.get_multi(server_keys.keys())
+		return dict((server_keys[server_key], value) for server_key, value in found.items())
+
+	def get(self, key, namespace = None):
+		return self.client.get(self.server_key(key, namespace))
+
+	def set_multi(self, mapping, time = 0, namespace = None):
+		server_keys = dict((self.server_key(key, namespace), key) for key in mapping)
+		failed = self.client.set_multi(dict((server_key, mapping[key]) for server_key, key in server_keys.items()), time = time)
+		return [server_keys[server_key] for server_key in failed]
+
+	def set(self, key, value, time = 0, namespace = None):
+		return bool(self.client.set(self.server_key(key, namespace), value, time = time))
+
+	def add(self, key, value, time = 0, namespace = None):
+		return bool(self.client.add(self.server_key(key, namespace), value, time = time))
+
+	def delete(self, key, namespace = None):
+		return self.client.delete(self.server_key(key, namespace))
+
+class AppEngineFetch(object):
+	"""urlfetch of App Engine."""
+	def __init__(self):
+		from google.appengine.api import apiproxy_stub_map, urlfetch
+		self.urlfetch = urlfetch
+		self.apiproxy_stub_map = apiproxy_stub_map
+
+	def create_rpc(self, deadline = None):
+		return self.urlfetch.create_rpc(deadline = deadline)
+
+	def make_fetch_call(self, rpc, url, **kw):
+		self.urlfetch.make_fetch_call(rpc, url, **kw)
+
+	def fetch(self, url, **kw):
+		return self.urlfetch.fetch(url, **kw)
+
+	def wait_any(self, rpcs):
+		return self.apiproxy_stub_map.UserRPC.wait_any(rpcs)
+
+class FetchResponse(object):
+	"""A response with the attributes of a urlfetch response."""
+	def __init__(self, status_code, content, headers, final_url):
+		self.status_code = status_code
+		self.content = content
+		self.headers = headers
+		self.final_url = final_url
+
+def time_left(expires):
+	"""Returns the seconds until expires, raises socket.timeout if there
+	are none."""
+	left = expires - time.time()
+	if left <= 0:
+		raise socket.timeout('Deadline exceeded')
+	return left
+
+class DeadlineSocket(object):
+	"""A socket whose every receive times out at expires, so a response
+	that trickles in is cut off too."""
+	def __init__(self, sock, expires):
+		self.sock = sock
+		self.expires = expires
+
+	def recv(self, size):
+		self.sock.settimeout(time_left(self.expires))
+		return self.sock.recv(size)
+
+	def makefile(self, mode = 'r', bufsize = -1):
+		# httplib reads the response from this file.
+		return socket._fileobject(self, mode, bufsize)
+
+	def close(self):
+		# httplib closes the connection before reading the response if the
+		# host closes it after. Like other sockets of Python 2, this one is
+		# only closed once nothing refers to it.
+		pass
+
+	def __getattr__(self, name):
+		return getattr(self.sock, name)
+
+class FetchRPC(object):
+	"""An asynchronous fetch of ThreadFetch. Its deadline counts from
+	the call on."""
+	def __init__(self, deadline):
+		self.deadline = deadline
+		self.expires = time.time() + deadline
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
+
+	def expired(self):
+		return time.time() >= self.expires
+
+	def get_result(self):
+		if not self.done.wait(max(self.expires - time.time(), 0)):
+			raise socket.timeout('Deadline exceeded')
+		if self.error is not None:
+			raise self.error
+		return self.result
+
+class ThreadFetch(object):
+	"""Fetches with httplib, the asynchronous calls on a pool of threads
+	which grows up to max_threads, so the calls of a request run
+	concurrently.
+
+	Every thread keeps its connections to each host alive, like urlfetch
+	does. The deadline bounds the whole fetch, redirects included: every
+	socket operation times out when it is over.
+	"""
+	REDIRECTS = (301, 302, 303, 307, 308)
+	MAX_REDIRECTS = 5
+
+	def __init__(self, max_threads = 64, default_deadline = 5):
+		self.max_threads = max_threads
+		self.default_deadline = default_deadline
+		self.tasks = Queue.Queue()
+		self.lock = threading.Lock()
+		self.threads = 0
+		self.idle = 0
+		# Notified whenever an asynchronous call completes, for wait_any.
+		self.completed = threading.Condition()
+		self.local = threading.local()
+
+	def create_rpc(self, deadline = None):
+		return FetchRPC(deadline or self.default_deadline)
+
+	def make_fetch_call(self, rpc, url, **kw):
+		rpc.expires = time.time() + rpc.deadline
+		self.tasks.put((rpc, url, kw))
+		with self.lock:
+			start = self.idle < self.tasks.qsize() and self.threads < self.max_threads
+			if start:
+				self.threads = self.threads + 1
+		if start:
+			thread = threading.Thread(target = self.work)
+			thread.daemon = True
+			thread.start()
+
+	def work(self):
+		while True:
+			with self.lock:
+				self.idle = self.idle + 1
+			rpc, url, kw = self.tasks.get()
+			with self.lock:
+				self.idle = self.idle - 1
+			try:
+				# The time spent waiting for a thread counts too.
+				rpc.result = self.fetch(url, deadline = time_left(rpc.expires), **kw)
+			except Exception as e:
+				rpc.error = e
+			with self.completed:
+				rpc.done.set()
+				self.completed.notify_all()
+
+	def wait_any(self, rpcs):
+		"""Returns one of rpcs that is done or past its deadline, waiting
+		for one if none is."""
+		rpcs = list(rpcs)
+		if not rpcs:
+			return None
+		with self.completed:
+			while True:
+				for rpc in rpcs:
+					if rpc.done.is_set() or rpc.expired():
+						return rpc
+				self.completed.wait(max(min(rpc.expires for rpc in rpcs) - time.time(), 0))
+
+	def fetch(self, url, payload = None, method = 'GET', headers = None, deadline = None, follow_redirects = True, **kw):
+		"""Fetches url on this thread, raises socket.error or
+		httplib.HTTPException if there is no response."""
+		expires = time.time() + (deadline or self.default_deadline)
+		for redirect in range(self.MAX_REDIRECTS + 1):
+			response = self.request(url, payload, method, headers or {}, expires)
+			location = response.headers.get('location')
+			if not follow_redirects or response.status_code not in self.REDIRECTS or not location:
+				break
+			url = urlparse.urljoin(url, location)
+			if response.status_code == 303 or (method == 'POST' and response.status_code in (301, 302)):
+				method, payload = 'GET', None
+		return response
+
+	def request(self, url, payload, method, headers, expires):
+		parts = urlparse.urlsplit(url)
+		path = parts.path or '/'
+		if parts.query:
+			path = path + '?' + parts.query
+		if not hasattr(self.local, 'connections'):
+			self.local.connections = {}
+		connections = self.local.connections
+		key = (parts.scheme, parts.netloc)
+		for attempt in range(2):
+			connection = connections.get(key)
+			reused = connection is not None
+			if connection is None:
+				connection_class = httplib.HTTPSConnection if parts.scheme == 'https' else httplib.HTTPConnection
+				connection = connections[key] = connection_class(parts.netloc)
+			try:
+				connection.timeout = time_left(expires)
+				if connection.sock is not None:
+					connection.sock.settimeout(connection.timeout)
+				connection.request(method, path, payload, headers)
+				if isinstance(connection.sock, DeadlineSocket):
+					connection.sock.expires = expires
+				else:
+					connection.sock = DeadlineSocket(connection.sock, expires)
+				response = connection.getresponse()
+				content = response.read()
+			except (httplib.HTTPException, socket.error) as e:
+				connection.close()
+				del connections[key]
+				# The host may have closed a connection that was idle for long.
+				if reused and not isinstance(e, socket.timeout):
+					continue
+				raise
+			return FetchResponse(response.status, content, dict(response.getheaders()), url)
+
+class AppEngineStorage(object):
+	"""ndb on the datastore of the App Engine app."""
+	def start_request(self):
+		pass
+
+class StandaloneStorage(AppEngineStorage):
+	"""ndb of the App Engine SDK outside App Engine."""
+	def __init__(self):
+		from google.appengine.ext import ndb
+		self.ndb = ndb
+
+	def start_request(self):
+		# ndb keeps a context per thread, which on App Engine is new for
+		# every request. There is no memcache of App Engine for it here.
+		context = self.ndb.get_context()
+		context.clear_cache()
+		context.set_memcache_policy(False)
+
+class LocalStorage(StandaloneStorage):
+	"""ndb on the datastore stub of the SDK, kept in a SQLite file. Only
+	one process may use the file."""
+	def __init__(self, path = DATASTORE_PATH):
+		super(LocalStorage, self).__init__()
+		from google.appengine.api import apiproxy_stub_map
+		from google.appengine.datastore import datastore_sqlite_stub
+		os.environ.setdefault('APPLICATION_ID', LOCAL_APP_ID)
+		# A testbed may have set up a stub already.
+		if apiproxy_stub_map.apiproxy.GetStub('datastore_v3') is None:
+			stub = datastore_sqlite_stub.DatastoreSqliteStub(os.environ['APPLICATION_ID'], path)
+			apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+
+class CloudStorage(StandaloneStorage):
+	"""ndb on Cloud Datastore through its API, shared by processes and
+	hosts. With DATASTORE_EMULATOR_HOST set, the emulator is used."""
+	def __init__(self, project_id = None):
+		project_id = project_id or os.environ.get('DATASTORE_PROJECT_ID')
+		if not project_id:
+			raise ValueError('Cloud Datastore needs DATASTORE_PROJECT_ID')
+		os.environ['DATASTORE_USE_CLOUD_DATASTORE'] = 'True'
+		os.environ['DATASTORE_PROJECT_ID'] = project_id
+		os.environ.setdefault('DATASTORE_USE_PROJECT_ID_AS_APP', 'True')
+		os.environ.setdefault('APPLICATION_ID', project_id)
+		super(CloudStorage, self).__init__()
+
+CACHES = {
+	'appengine': AppEngineCache,
+	'memory': MemoryCache,
+	'memcached': lambda: MemcachedCache(os.environ.get('MEMCACHED_SERVERS', '127.0.0.1:11211').split(',')),
+}
+FETCHES = {
+	'appengine': AppEngineFetch,
+	'threads': ThreadFetch,
+}
+STORAGES = {
+	'appengine': AppEngineStorage,
+	'local': LocalStorage,
+	'cloud': CloudStorage,
+}
+
+def make_backend(backends, name):
+	if name not in backends:
+		raise ValueError('Unknown backend %s, choose from %s' % (name, ', '.join(sorted(backends))))
+	return backends[name]()
+
+cache = make_backend(CACHES, os.environ.get('ASKNOW_CACHE', 'appengine'))
+fetch = make_backend(FETCHES, os.environ.get('ASKNOW_FETCH', 'appengine'))
+storage = make_backend(STORAGES, os.environ.get('ASKNOW_STORAGE', 'appengine'))
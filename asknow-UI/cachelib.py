@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Janko Hoener
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import collections
+import threading
+import time
+import logging
+import backends
+
+# Stored instead of a value to remember that an upstream had no result.
+NEGATIVE = '__asknow_negative__'
+
+class LRUCache(object):
+	"""A bounded, thread-safe in-process cache with a TTL per entry."""
+	def __init__(self, maxsize = 1000):
+		self.maxsize = maxsize
+		self.lock = threading.Lock()
+		self.entries = collections.OrderedDict()
+
+	def get(self, key):
+		"""Returns (hit, value) for key."""
+		with self.lock:
+			entry = self.entries.pop(key, None)
+			if entry is None:
+				return False, None
+			value, expires = entry
+			if expires < time.time():
+				return False, None
+			self.entries[key] = entry
+			return True, value
+
+	def set(self, key, value, ttl):
+		with self.lock:
+			self.entries.pop(key, None)
+			self.entries[key] = (value, time.time() + ttl)
+			while len(self.entries) > self.maxsize:
+				self.entries.popitem(last = False)
+
+	def delete(self, key):
+		with self.lock:
+			self.entries.pop(key, None)
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+
+	def __len__(self):
+		return len(self.entries)
+
+class TwoLevelCache(object):
+	"""An in-process LRU in front of the shared cache, e.g. memcache.
+
+	None values are stored as NEGATIVE entries with a short TTL, so
+	failed upstream lookups are not repeated on every request.
+	"""
+	def __init__(self, namespace, maxsize = 1000, negative_ttl = 60, local_ttl = 300):
+		self.namespace = namespace
+		self.local = LRUCache(maxsize)
+		self.negative_ttl = negative_ttl
+		self.local_ttl = local_ttl
+		self.lock = threading.Lock()
+		self.counters = collections.Counter()
+
+	def count(self, counter, n = 1):
+		with self.lock:
+			self.counters[counter] += n
+
+	def get_multi(self, keys):
+		"""Returns a dict of the keys found, mapped to their values.
+
+		Negative entries are returned as None.
+		"""
+		found = {}
+		missing = []
+		for key in keys:
+			hit, value = self.local.get(key)
+			if hit:
+				found[key] = value
+			else:
+				missing.append(key)
+		self.count('local_hits', len(found))
+		if missing:
+			try:
+				cached = backends.cache.get_multi(missing, namespace = self.namespace)
+			except Exception:
+				logging.exception('Cannot read from the shared cache')
+				cached = {}
+			self.count('memcache_hits', len(cached))
+			self.count('misses', len(missing) - len(cached))
+			for key, value in cached.items():
+				# The remaining TTL is unknown here, keep it locally only briefly.
+				if value == NEGATIVE:
+					self.local.set(key, value, self.negative_ttl)
+				else:
+					self.local.set(key, value, self.local_ttl)
+				found[key] = value
+		negative = [key for key, value in found.items() if value == NEGATIVE]
+		self.count('negative_hits', len(negative))
+		for key in negative:
+			found[key] = None
+		return found
+
+	def get(self, key):
+		"""Returns (hit, value) for key."""
+		found = self.get_multi([key])
+		if key in found:
+			return True, found[key]
+		return False, None
+
+	def set_multi(self, mapping, ttl):
+		"""Stores mapping for ttl seconds; None values are cached negatively."""
+		by_ttl = {}
+		for key, value in mapping.items():
+			if value is None:
+				by_ttl.setdefault(self.negative_ttl, {})[key] = NEGATIVE
+			else:
+				by_ttl.setdefault(ttl, {})[key] = value
+		for cur_ttl, values in by_ttl.items():
+			for key, value in values.items():
+				self.local.set(key, value, cur_ttl)
+			try:
+				backends.cache.set_multi(values, time = cur_ttl, namespace = self.namespace)
+			except Exception:
+				logging.exception('Cannot write to the shared cache')
+
+	def set(self, key, value, ttl):
+		self.set_multi({key: value}, ttl)
+
+	def stats(self):
+		with self.lock:
+			stats = dict(self.counters)
+		stats['local_size'] = len(self.local)
+		return stats
+
+class _Call(object):
+	def __init__(self):
+		self.event = threading.Event()
+		self.result = None
+		self.error = None
+
+class SingleFlight(object):
+	"""Collapses concurrent calls with the same key into a single call.
+
+	The first caller runs the function, the others wait for its result.
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.calls = {}
+
+	def do(self, key, func, *args, **kw):
+		with self.lock:
+			call = self.calls.get(key)
+			leader = call is None
+			if leader:
+				call = self.calls[key] = _Call()
+		if not leader:
+			call.event.wait()
+			if call.error is not None:
+				raise call.error
+			return call.result
+		try:
+			call.result = func(*args, **kw)
+		except Exception as e:
+			call.error = e
+			raise
+		finally:
+			with self.lock:
+				del self.calls[key]
+			call.event.set()
+		return call.result
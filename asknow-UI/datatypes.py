@@ -22,7 +22,43 @@ class AskNowUser(ndb.Model):
 	email = ndb.StringProperty()
 	created = ndb.DateTimeProperty(auto_now_add=True)
 	
+class AskNowSecret(ndb.Model):
+	# A random key, created once for all instances, see get_session_key.
+	value = ndb.StringProperty(required = True, indexed = False)
+
 class AskNowQuestion(ndb.Model):
 	userid = ndb.KeyProperty(AskNowUser, required=True)
 	question = ndb.StringProperty(required=True)
-	asked = ndb.DateTimeProperty(auto_now_add=True)
\ No newline at end of file
+	asked = ndb.DateTimeProperty(auto_now_add=True)
+
+class AskNowRecentQuestions(ndb.Model):
+	"""The most recent questions of a user, newest first.
+
+	The key id is the id of the user, so the questions are read with a
+	single get instead of a query over AskNowQuestion. It is written
+	together with the cached list of questions of the user.
+	"""
+	MAX_QUESTIONS = 5
+	questions = ndb.StringProperty(repeated=True, indexed=False)
+
+	@classmethod
+	def key_for(cls, userkey):
+		return ndb.Key(cls, userkey.id())
+
+	@classmethod
+	@ndb.transactional_tasklet
+	def add_async(cls, userkey, question, known = ()):
+		"""Puts question first in the recent questions of the user in a
+		transaction, so questions asked at once are all kept. Without an
+		entity yet, the user starts with the questions known.
+
+		Returns a future for the new list of questions.
+		"""
+		key = cls.key_for(userkey)
+		recent = yield key.get_async()
+		if recent is None:
+			recent = cls(key = key, questions = list(known))
+		recent.questions = ([question] + list(recent.questions))[:cls.MAX_QUESTIONS]
+		yield recent.put_async()
+		raise ndb.Return(list(recent.questions))
+
@@ -15,95 +15,100 @@
 
 
 import json
-from google.appengine.api import memcache, urlfetch
+from google.appengine.ext import ndb
 import logging
 from handlerlib import *
 from datatypes import *
 from userauth import *
+from answerlib import answer_service, decode_strings
+from threadlib import parallel_map
+import backends
+import upstream
 import urllib, urllib2
 from urllib2 import Request
 import os, sys
+import itertools
 from google.appengine.api.urlfetch_errors import *
 
 class AskNowDemoHandler(Handler):
-	ASKNOW_URL = 'https://jankos-project.appspot.com/asknow/json' # FIXME: use real AskNow
+	ASKNOW_URL = os.environ.get('ASKNOW_URL') # remote AskNow, only used as a fallback
 	DEMO_URL = 'demo.html'
 	ANSWER_URL = 'demo_answer.html'
+	MAX_WORKERS = 5
 	
 	def render_page(self, template, loggedin = ''):
 		self.render(template, loggedin = loggedin)
+
+	def error_answer(self, q, status, message):
+		cur_answer = {}
+		cur_answer['status'] = status
+		cur_answer['message'] = message
+		cur_answer['leninfo'] = 0
+		cur_answer['lentitles'] = 0
+		cur_answer['question'] = q
+		cur_answer['answered'] = False
+		return cur_answer
 	
 	def retrieve_answers(self, q):
+		logging.info('Answering question "%s" with AskNow' % q)
+		try:
+			cur_answer = answer_service.answer_lazily(q)
+			if 'information' in cur_answer:
+				cur_answer['information'] = itertools.imap(decode_strings, cur_answer['information'])
+			cur_answer = decode_strings(cur_answer)
+		except Exception:
+			logging.exception('Cannot answer question "%s" in process' % q)
+			if self.ASKNOW_URL:
+				return self.retrieve_remote_answers(q)
+			return self.error_answer(q, 2, 'Cannot answer question with AskNow.')
+		cur_answer['status'] = 0
+		cur_answer['message'] = 'Answer successfully retrieved from AskNow'
+		return cur_answer
+
+	def retrieve_remote_answers(self, q):
 		params = { 'q': q.encode('utf-8') }
 		cur_answer = {}
 		logging.info('Retrieving answers for question "%s" from AskNow' % q)
 		url = self.ASKNOW_URL + '?%s' % urllib.urlencode(params)
-		retry = 2
-		while retry:
-			try:
-				result = urlfetch.fetch(url)
-			except:
-				retry = retry - 1
-				if not retry:
-					exc_type, exc_value, exc_traceback = sys.exc_info()
-					logging.debug(exc_value)
-					cur_answer['status'] = 2
-					cur_answer['message'] = 'Cannot reach AskNow API.'
-					cur_answer['leninfo'] = 0
-					cur_answer['lentitles'] = 0
-					cur_answer['question'] = q
-					cur_answer['answered'] = False
-					return cur_answer
-			else:
-				if result.status_code == 200:
-					logging.info('Retrieved answers for question "%s" from AskNow, proceeding.' % q)
-					cur_answer = json.loads(result.content)
-					cur_answer['status'] = 0
-					cur_answer['message'] = 'Answer successfully retrieved from AskNow'
-				else:
-					cur_answer['status'] = 4
-					cur_answer['message'] = 'Retrieved status code != 200 from AskNow'
-					cur_answer['leninfo'] = 0
-					cur_answer['lentitles'] = 0
-					cur_answer['question'] = q
-					cur_answer['answered'] = False
-				return cur_answer
+		result = upstream.asknow.fetch(url)
+		if result is None:
+			return self.error_answer(q, 2, 'Cannot reach AskNow API.')
+		if result.status_code == 200:
+			logging.info('Retrieved answers for question "%s" from AskNow, proceeding.' % q)
+			cur_answer = json.loads(result.content)
+			cur_answer.setdefault('leninfo', len(cur_answer.get('information') or []))
+			cur_answer['status'] = 0
+			cur_answer['message'] = 'Answer successfully retrieved from AskNow'
+		else:
+			cur_answer = self.error_answer(q, 4, 'Retrieved status code != 200 from AskNow')
+		return cur_answer
+
+	@ndb.tasklet
+	def add_question_async(self, userdbkey, qkey, q, known):
+		# The cached questions are replaced by those written in the
+		# transaction, which include the questions asked meanwhile.
+		questions = yield AskNowRecentQuestions.add_async(userdbkey, q, known)
+		backends.cache.set(qkey, questions)
 
 	def get(self):
 		logging.info('Start building demo page')
 		q = self.request.get('q')
 		self.response.headers['Content-Type'] = 'text/html; charset=UTF-8'
 		auth = True
-		cookie_data = self.request.cookies.get('userid')
+		cookie_data = self.request.cookies.get(self.SESSION_COOKIE)
 		if cookie_data:
 			logging.info('Cookie for userid is set, reading.')
-			cookie_data_split = cookie_data.split('|')
-			if len(cookie_data_split) == 2:
-				logging.info('Cookie split at |, checking hash.')
-				userkeystr = cookie_data_split[0]
-				userhash = cookie_data_split[1]
-				if self.hash_str(userkeystr) == userhash:
-					auth = True
-					logging.info('Authentification successful, retrieving user for id %s' % userkeystr)
-					key = 'user-%s' % userkeystr
-					user = memcache.get(key)
-					if user:
-						logging.info('User retrieved from cache.')
-					else:
-						logging.info('User not found in cache, retrieving from database.')
-						userkey = int(userkeystr)
-						user = AskNowUser.get_by_id(userkey)
-						logging.info('User retrieved from database')
-						memcache.set(key, user)
-					userdbkey = user.key
-					username = user.username	 
-				else:
-					logging.info('Authentification not successful, resetting cookie and continuing as anonymous user')
-					self.reset_cookie('userid')
-					auth = False
+			session = self.read_session_token(cookie_data)
+			if session:
+				auth = True
+				userid, username = session
+				userdbkey = ndb.Key(AskNowUser, userid)
+				logging.info('Authentification successful for user id %s' % userid)
 			else:
-				logging.info('Cookie for userid misformatted, resetting cookie and continuing as anonymous user')
-				self.reset_cookie('userid')
+				# Also cookies from before session tokens, which anyone could
+				# forge, so their users log in again.
+				logging.info('Authentification not successful, resetting cookie and continuing as anonymous user')
+				self.reset_cookie(self.SESSION_COOKIE)
 				auth = False
 		else:
 			logging.info('Cookie for userid not set, continuing as anonymous user')
@@ -117,38 +122,51 @@ class AskNowDemoHandler(Handler):
 			answerslist = []
 			answerslist.append(self.retrieve_answers(q))
 			logging.info('Answers loaded, rendering.')
-			self.render(self.ANSWER_URL, answerslist = answerslist, q = q)
+			self.render_stream(self.ANSWER_URL, answerslist = answerslist, q = q)
 			return
 		# if auth:
 		qkey = 'questions-%s' % username
 		logging.info('User authentificated, loading former questions from cache.')
-		cache = memcache.get(qkey)
-		if cache:
+		cache = backends.cache.get(qkey)
+		recent_key = AskNowRecentQuestions.key_for(userdbkey)
+		if cache is not None:
 			logging.info('Questions found in cache, loading answers')
 			questions = cache
 		else:
 			logging.info('Questions not found in cache, loading from database')
-			query = AskNowQuestion.query(AskNowQuestion.userid == userdbkey, distinct=True, projection=[AskNowQuestion.asked, AskNowQuestion.question]).order(-AskNowQuestion.asked)
-			query = list(query)
-			questions = []
-			for res in query:
-				questions.append(res.question)
+			recent = recent_key.get()
+			if recent is not None:
+				questions = list(recent.questions)
+			else:
+				# Users from before AskNowRecentQuestions existed, done once per user.
+				query = AskNowQuestion.query(AskNowQuestion.userid == userdbkey, distinct=True, projection=[AskNowQuestion.asked, AskNowQuestion.question]).order(-AskNowQuestion.asked)
+				query = query.fetch(AskNowRecentQuestions.MAX_QUESTIONS)
+				questions = []
+				for res in query:
+					questions.append(res.question)
+				if not q:
+					# Without a question the entity is stored here, so the scan
+					# is not repeated. It does not replace one written meanwhile.
+					self.after_response(AskNowRecentQuestions.get_or_insert_async(recent_key.id(), questions = questions))
 			logging.info('Questions loaded from database.')
+			if not q:
+				backends.cache.set(qkey, questions)
+				logging.info('Most recent questions added to cache.')
 		if q:
-			questions.insert(0, q)
 			new_question = AskNowQuestion(userid = userdbkey, question = q)
-			new_question.put()
+			# The page does not wait for these writes, see Handler.after_response.
+			self.after_response(new_question.put_async())
+			self.after_response(self.add_question_async(userdbkey, qkey, q, questions))
+			questions = [q] + questions
 			logging.info('New question added to list and to database.')
-		display_questions = questions[:5]
-		memcache.set(qkey, display_questions)
-		logging.info('5 most recent questions added to cache, loading answers for questions.')
+		display_questions = questions[:AskNowRecentQuestions.MAX_QUESTIONS]
+		logging.info('Loading answers for the most recent questions.')
 		answerslist = []
 		error = ''
 		message = ''
-		for question in display_questions:
-			cur_answers = self.retrieve_answers(question)
+		for cur_answers in parallel_map(self.retrieve_answers, display_questions, self.MAX_WORKERS):
 			if cur_answers:
 				answerslist.append(cur_answers)
-				logging.info('Retrieved answers for question "%s"' % question)
+		logging.info('Retrieved answers for %s questions' % len(answerslist))
 		logging.info('Rendering answer page.')
-		self.render(self.ANSWER_URL, answerslist = answerslist, q = q, error = error, message = message, loggedin = username)
\ No newline at end of file
+		self.render_stream(self.ANSWER_URL, answerslist = answerslist, q = q, error = error, message = message, loggedin = username)
\ No newline at end of file
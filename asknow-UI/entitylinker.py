@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Janko Hoener
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A gazetteer of DBpedia resource labels for linking entities locally.
+
+The labels are the patterns of an Aho-Corasick automaton over tokens, so
+all labels in a question are found in one pass over its tokens. The
+automaton is built offline from a gzipped N-Triples label dump, which is
+read line by line like ZipLuceneIndexCreator reads one, and saved with
+marshal, so an instance only loads it:
+  python entitylinker.py labels_en.ttl.gz data/gazetteer.marshal \\
+    --disambiguations disambiguations_en.ttl.gz
+"""
+import argparse
+import gzip
+import logging
+import marshal
+import os
+import re
+import threading
+import time
+import urllib
+from titles import retrieve_title_from_url
+
+GAZETTEER_PATH = os.environ.get('GAZETTEER_PATH',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'gazetteer.marshal'))
+DBPEDIA_RESOURCE = 'http://dbpedia.org/resource/'
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+LITERAL_RE = re.compile(r'^"(.*)"(?:@[\w-]+|\^\^<[^>]*>)?$')
+ESCAPE_RE = re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)')
+ESCAPES = {'t': u'\t', 'n': u'\n', 'r': u'\r', 'b': u'\b', 'f': u'\f', '"': u'"', "'": u"'", '\\': u'\\'}
+# Words that do not name an entity, they are not counted for confidence.
+STOPWORDS = frozenset([u'a', u'an', u'and', u'are', u'as', u'at', u'be', u'by', u'did', u'do',
+	u'does', u'for', u'from', u'give', u'has', u'have', u'how', u'in', u'is', u'it', u'many',
+	u'me', u'much', u'of', u'on', u'or', u'the', u'to', u'was', u'were', u'what', u'when',
+	u'where', u'which', u'who', u'whom', u'whose', u'why', u'with'])
+SHIFT = 24 # bits of a token id in a transition key
+# A label of one word in more labels than this, like "population" or
+# "capital", is too common to make the linking confident.
+COMMON_LABELS = 50
+AMBIGUOUS = -1 # title of a label shared by several resources
+NONE = -2
+
+def tokenize(text):
+	if isinstance(text, str):
+		text = text.decode('utf-8', 'replace')
+	return TOKEN_RE.findall(text.lower())
+
+def unescape(literal):
+	if u'\\' not in literal:
+		return literal
+
+	def replace(match):
+		escape = match.group(1)
+		if escape[0] in 'uU':
+			return unichr(int(escape[1:], 16))
+		return ESCAPES.get(escape, escape)
+	return ESCAPE_RE.sub(replace, literal)
+
+def parse_triple(line):
+	"""Returns the (subject, predicate, object) of an N-Triples line as
+	UTF-8 strings, or None for comments and other lines."""
+	if line.startswith('#'):
+		return None # ignore comments
+	parts = line.split(None, 2)
+	if len(parts) < 3:
+		return None
+	obj = parts[2].rstrip()
+	if obj.endswith('.'):
+		obj = obj[:-1].rstrip()
+	return parts[0].strip('<>'), parts[1].strip('<>'), obj
+
+def read_triples(path):
+	"""Yields the triples of the gzipped N-Triples file at path."""
+	f = gzip.open(path, 'rb')
+	try:
+		for line in f:
+			triple = parse_triple(line)
+			if triple is not None:
+				yield triple
+	finally:
+		f.close()
+
+def parse_label(triple, excluded = frozenset()):
+	"""Returns (label, title) if triple labels a DBpedia resource not in
+	excluded, or None."""
+	subject, predicate, obj = triple
+	if not subject.startswith(DBPEDIA_RESOURCE) or subject in excluded:
+		return None
+	match = LITERAL_RE.match(obj)
+	if not match:
+		return None
+	title = retrieve_title_from_url(unescape(urllib.unquote(subject).decode('utf-8', 'replace')))
+	# Disambiguated titles like "Mercury (planet)" are only found by context.
+	if u'(' in title:
+		return None
+	return unescape(match.group(1).decode('utf-8', 'replace')), title
+
+def read_labels(path, excluded = frozenset()):
+	"""Yields (label, title) for the DBpedia resources labelled in the dump
+	at path, except for the subjects in excluded."""
+	for triple in read_triples(path):
+		entry = parse_label(triple, excluded)
+		if entry is not None:
+			yield entry
+
+def add_label(labels, tokens, title):
+	"""Adds the label of title with tokens to the dict labels, from token
+	tuples to titles. Labels of several titles are AMBIGUOUS."""
+	if not tokens or all(token in STOPWORDS or token.isdigit() for token in tokens):
+		return
+	known = labels.get(tokens)
+	if known is None:
+		labels[tokens] = title
+	elif known != title:
+		labels[tokens] = AMBIGUOUS
+
+def merge_labels(labels, other):
+	"""Adds the labels of other to labels, both as filled by add_label."""
+	for tokens, title in other.iteritems():
+		if title == AMBIGUOUS:
+			labels[tokens] = AMBIGUOUS
+		else:
+			add_label(labels, tokens, title)
+
+class Gazetteer(object):
+	"""An Aho-Corasick automaton whose symbols are the tokens of labels.
+
+	States are numbered, state 0 is the root. The transitions of all
+	states are kept in one dict keyed by state << SHIFT | token id, the
+	other properties of the states in lists indexed by state.
+	"""
+	def __init__(self, vocabulary, goto, fail, output, depth, titles, frequency):
+		self.vocabulary = vocabulary
+		self.goto = goto
+		self.fail = fail
+		self.output = output # per state: title id of the label ending here, or NONE
+		self.depth = depth
+		self.titles = titles
+		self.frequency = frequency # per token id: number of labels with the token
+
+	@classmethod
+	def build(cls, entries):
+		"""Builds the automaton from (label, title) pairs."""
+		labels = {}
+		for label, title in entries:
+			add_label(labels, tuple(tokenize(label)), title)
+		return cls.from_labels(labels)
+
+	@classmethod
+	def from_labels(cls, labels):
+		"""Builds the automaton from a dict filled by add_label."""
+		vocabulary = {}
+		frequency = []
+		goto = {}
+		output = [NONE]
+		depth = [0]
+		children = [[]]
+		titles = []
+		title_ids = {}
+		for tokens, title in labels.iteritems():
+			state = 0
+			for token in set(tokens):
+				token_id = vocabulary.setdefault(token, len(vocabulary))
+				if token_id == len(frequency):
+					frequency.append(0)
+				frequency[token_id] += 1
+			for token in tokens:
+				token_id = vocabulary[token]
+				key = state << SHIFT | token_id
+				if key not in goto:
+					goto[key] = len(output)
+					children[state].append((token_id, len(output)))
+					output.append(NONE)
+					depth.append(depth[state] + 1)
+					children.append([])
+				state = goto[key]
+			if title == AMBIGUOUS:
+				output[state] = AMBIGUOUS
+				continue
+			if title not in title_ids:
+				title_ids[title] = len(titles)
+				titles.append(title)
+			output[state] = title_ids[title]
+		if len(vocabulary) >= 1 << SHIFT:
+			raise ValueError('%s tokens do not fit in %s bits of a transition key' % (len(vocabulary), SHIFT))
+		# The failure links are set breadth first, from the longest proper
+		# suffix of every state that is also a prefix.
+		fail = [0] * len(output)
+		queue = [child for token_id, child in children[0]]
+		for state in queue:
+			for token_id, child in children[state]:
+				f = fail[state]
+				while f and (f << SHIFT | token_id) not in goto:
+					f = fail[f]
+				fail[child] = goto.get(f << SHIFT | token_id, 0)
+				queue.append(child)
+		return cls(vocabulary, goto, fail, output, depth, titles, frequency)
+
+	@classmethod
+	def load(cls, path = GAZETTEER_PATH):
+		with open(path, 'rb') as f:
+			return cls(*marshal.load(f))
+
+	def save(self, path):
+		tmppath = path + '.tmp'
+		with open(tmppath, 'wb') as f:
+			marshal.dump((self.vocabulary, self.goto, self.fail, self.output, self.depth, self.titles,
+				self.frequency), f)
+		os.rename(tmppath, path)
+
+	def matches(self, tokens):
+		"""Yields (start, end, title id) for every label in tokens."""
+		state = 0
+		for i, token in enumerate(tokens):
+			token_id = self.vocabulary.get(token)
+			if token_id is None:
+				state = 0
+				continue
+			while state and (state << SHIFT | token_id) not in self.goto:
+				state = self.fail[state]
+			state = self.goto.get(state << SHIFT | token_id, 0)
+			match = state
+			while match:
+				if self.output[match] != NONE:
+					yield i + 1 - self.depth[match], i + 1, self.output[match]
+				match = self.fail[match]
+
+	def link(self, text):
+		"""Returns the titles of the entities in text and the confidence of
+		the linking, from 0 to 1.
+
+		The longest labels are chosen first, without overlaps. Only the
+		titles of specific labels are returned: labels of several words
+		apart from STOPWORDS and labels whose word is in at most
+		COMMON_LABELS labels. The confidence is the share of the words of
+		text, apart from STOPWORDS, covered by them. It is 0 if a chosen
+		label is ambiguous.
+		"""
+		tokens = tokenize(text)
+		chosen = []
+		taken = [False] * len(tokens)
+		for start, end, title_id in sorted(self.matches(tokens), key = lambda m: (m[0] - m[1], m[0])):
+			if any(taken[start:end]):
+				continue
+			for i in xrange(start, end):
+				taken[i] = True
+			chosen.append((start, end, title_id))
+		chosen.sort()
+		if any(title_id == AMBIGUOUS for start, end, title_id in chosen):
+			return [], 0.0
+		words = [i for i, token in enumerate(tokens) if token not in STOPWORDS]
+		if not words:
+			return [], 0.0
+		specific = [False] * len(tokens)
+		titles = []
+		for start, end, title_id in chosen:
+			label_words = [token for token in tokens[start:end] if token not in STOPWORDS]
+			if len(label_words) > 1 or all(self.frequency[self.vocabulary[token]] <= COMMON_LABELS for token in label_words):
+				specific[start:end] = [True] * (end - start)
+				if self.titles[title_id] not in titles:
+					titles.append(self.titles[title_id])
+		covered = len([i for i in words if specific[i]])
+		return titles, float(covered) / len(words)
+
+	def link_confidently(self, text, min_confidence):
+		"""Returns the titles of the entities in text, or None unless the
+		linking is more confident than min_confidence, so the entities are
+		to be looked up otherwise."""
+		titles, confidence = self.link(text)
+		if not titles or confidence <= min_confidence:
+			return None
+		return titles
+
+	def __len__(self):
+		return len(self.titles)
+
+_gazetteer = None
+_gazetteer_loaded = False
+_gazetteer_lock = threading.Lock()
+
+def get_gazetteer():
+	"""Returns the gazetteer of this instance, loading it on first use, or
+	None if there is none."""
+	global _gazetteer, _gazetteer_loaded
+	if not _gazetteer_loaded:
+		with _gazetteer_lock:
+			if not _gazetteer_loaded:
+				if os.path.exists(GAZETTEER_PATH):
+					start = time.time()
+					_gazetteer = Gazetteer.load(GAZETTEER_PATH)
+					logging.info('Loaded %s entities from %s in %.2fs' % (len(_gazetteer), GAZETTEER_PATH, time.time() - start))
+				_gazetteer_loaded = True
+	return _gazetteer
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Builds a gazetteer from a gzipped N-Triples label dump.')
+	parser.add_argument('labels', help = 'gzipped N-Triples file of rdfs:label triples, e.g. labels_en.ttl.gz')
+	parser.add_argument('gazetteer', nargs = '?', default = GAZETTEER_PATH)
+	parser.add_argument('--disambiguations', help = 'gzipped N-Triples file whose subjects are left out')
+	args = parser.parse_args()
+	excluded = set()
+	if args.disambiguations:
+		excluded = set(subject for subject, predicate, obj in read_triples(args.disambiguations))
+	start = time.time()
+	gazetteer = Gazetteer.build(read_labels(args.labels, excluded))
+	gazetteer.save(args.gazetteer)
+	print 'Wrote %s entities with %s states to %s in %.0fs.' % (len(gazetteer), len(gazetteer.output),
+		args.gazetteer, time.time() - start)
@@ -16,6 +16,17 @@ import webapp2
 import os
 import jinja2
 import hashlib, uuid
+import zlib
+import json
+import logging
+import threading
+import time
+import backends
+import sessions
+from datatypes import AskNowSecret
+from cachelib import LRUCache
+from titles import encode_title, retrieve_title_from_url
+import tracelib
 
 ASKNOW_PATH = '/asknow/'
 
@@ -36,15 +47,95 @@ def answerclass(answers):
 	else:
 		return 'not-answered'
 
+class MemcacheBytecodeCache(jinja2.BytecodeCache):
+	"""Keeps compiled templates in memcache, so a new instance does not
+	compile them again.
+
+	The bucket key only hashes the name and file name of a template. The
+	checksum of its source is stored with the bytecode and checked when
+	the bucket loads, so a changed template is compiled anew and its
+	bytecode replaced.
+	"""
+	PREFIX = 'jinja2-'
+
+	def load_bytecode(self, bucket):
+		code = backends.cache.get(self.PREFIX + bucket.key)
+		if code is not None:
+			bucket.bytecode_from_string(code)
+
+	def dump_bytecode(self, bucket):
+		backends.cache.set(self.PREFIX + bucket.key, bucket.bytecode_to_string())
+
+def accepts_gzip(accept_encoding):
+	"""Returns whether an Accept-Encoding header accepts gzip, with a
+	q-value above 0 for gzip or else for *."""
+	qvalues = {}
+	for item in accept_encoding.split(','):
+		params = item.split(';')
+		coding = params[0].strip().lower()
+		q = 1.0
+		for param in params[1:]:
+			name, _, value = param.partition('=')
+			if name.strip().lower() == 'q':
+				try:
+					q = float(value)
+				except ValueError:
+					q = 0.0
+		if coding:
+			qvalues[coding] = q
+	for coding in ('gzip', 'x-gzip', '*'):
+		if coding in qvalues:
+			return qvalues[coding] > 0
+	return False
+
+_session_key = None
+_session_key_lock = threading.Lock()
+
+def get_session_key():
+	"""Returns the key session tokens are signed with: ASKNOW_SECRET, or a
+	random key kept in the datastore, created on first use."""
+	global _session_key
+	if _session_key is None:
+		with _session_key_lock:
+			if _session_key is None:
+				key = os.environ.get('ASKNOW_SECRET')
+				if not key:
+					secret = AskNowSecret.get_or_insert('session', value = os.urandom(32).encode('hex'))
+					key = secret.value
+				_session_key = key.encode('utf-8') if isinstance(key, unicode) else key
+	return _session_key
+
+FRAGMENT_CACHE_SIZE = 500
+FRAGMENT_CACHE_TTL = 3600
+fragment_cache = LRUCache(FRAGMENT_CACHE_SIZE)
+
+def render_fragment(template, **params):
+	"""Renders a part of a page, reusing the HTML rendered before for the
+	same template and parameters.
+
+	Values that are not JSON, like the lazy information of an answer, are
+	not part of the key, so a fragment must not render them.
+	"""
+	key = hashlib.sha1(json.dumps([template, params], sort_keys = True, separators = (',', ':'),
+		check_circular = False, default = lambda o: None)).hexdigest()
+	hit, html = fragment_cache.get(key)
+	if not hit:
+		html = jinja2.Markup(Handler.jinja_env.get_template(template).render(params))
+		fragment_cache.set(key, html, FRAGMENT_CACHE_TTL)
+	return html
+
 class Handler(webapp2.RequestHandler):
 	template_dir = os.path.join(os.path.dirname(__file__), 'templates')
 	
 	jinja_env = jinja2.Environment(loader = jinja2.FileSystemLoader(template_dir), 
-	autoescape = True)
+	autoescape = True, bytecode_cache = MemcacheBytecodeCache())
 	jinja_env.filters['joinfunc'] = joinfunc
 	jinja_env.filters['answerclass'] = answerclass
+	jinja_env.globals['fragment'] = render_fragment
 	
-	SECRET = "The AskNow secret"
+	GZIP_MIN_SIZE = 1024
+	SESSION_COOKIE = 'userid'
+	SESSION_MAX_AGE = 30 * 24 * 3600
 	
 	def write(self, *a, **kw):
 		self.response.out.write(*a, **kw)
@@ -54,11 +145,96 @@ class Handler(webapp2.RequestHandler):
 		return t.render(params)
 		
 	def render(self, template, **kw):
-		self.write(self.render_str(template, **kw))
-		
-	def hash_str(self, s):
-		return hashlib.sha256(self.SECRET + str(s)).hexdigest()
+		with tracelib.span('render'):
+			self.write(self.render_str(template, **kw))
+
+	def write_cacheable(self, body, content_type):
+		"""Writes body with an ETag of its hash, answering a matching
+		If-None-Match with 304 Not Modified. Clients accepting gzip get it
+		compressed."""
+		etag = 'W/"%s"' % hashlib.sha1(body).hexdigest()
+		self.response.headers['ETag'] = etag
+		self.response.headers['Vary'] = 'Accept-Encoding'
+		if_none_match = self.request.headers.get('If-None-Match', '')
+		tags = [tag.strip() for tag in if_none_match.split(',')]
+		if '*' in tags or etag in tags or etag[2:] in tags:
+			self.response.set_status(304)
+			return
+		self.response.headers['Content-Type'] = content_type
+		if len(body) >= self.GZIP_MIN_SIZE and accepts_gzip(self.request.headers.get('Accept-Encoding', '')):
+			compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+			body = compressor.compress(body) + compressor.flush()
+			self.response.headers['Content-Encoding'] = 'gzip'
+		self.write(body)
+
+	def render_stream(self, template, **params):
+		# Sends the page while it is rendered, e.g. while lazy values are
+		# still being retrieved.
+		t = self.jinja_env.get_template(template)
+		self.response.app_iter = self.stream(t.generate(params))
+		self.streaming = True
+
+	def stream(self, chunks):
+		# The Server-Timing header is sent before the page, so the time to
+		# render it only goes to the histogram.
+		start = time.time()
+		try:
+			for chunk in chunks:
+				yield chunk.encode('utf-8')
+			tracelib.record('render', time.time() - start)
+		finally:
+			self.wait_after_response()
+
+	def dispatch(self):
+		trace = tracelib.start_trace()
+		backends.storage.start_request()
+		self.streaming = False
+		streaming = False
+		try:
+			result = super(Handler, self).dispatch()
+			streaming = self.streaming
+			return result
+		finally:
+			elapsed = time.time() - trace.started
+			trace.add('total', elapsed * 1000.0)
+			tracelib.histogram('request.%s' % self.__class__.__name__).add(elapsed * 1000.0)
+			self.response.headers['Server-Timing'] = trace.server_timing()
+			tracelib.end_trace()
+			# A streamed page completes the work after it is sent, otherwise
+			# it is completed here, also if the handler failed.
+			if not streaming:
+				self.wait_after_response()
+
+	def after_response(self, future):
+		# Asynchronous work, e.g. a put_async, that the response does not
+		# wait for. It is completed once a streamed page has been sent, or
+		# else when the handler returns or fails.
+		if not hasattr(self, 'futures'):
+			self.futures = []
+		self.futures.append(future)
+
+	def wait_after_response(self):
+		for future in getattr(self, 'futures', []):
+			try:
+				future.get_result()
+			except Exception:
+				logging.exception('Asynchronous work after the response failed')
+		self.futures = []
 		
+	def make_session_token(self, userid, username):
+		# The token carries everything a page needs about the user.
+		return sessions.make_token(get_session_key(), userid, username, self.SESSION_MAX_AGE)
+
+	def read_session_token(self, token):
+		"""Returns (user id, username) of a valid session token, or None.
+		Cookies from before session tokens are not valid, their users log
+		in again."""
+		return sessions.read_token(get_session_key(), token)
+
+	def set_session_cookie(self, userid, username):
+		self.response.headers.add_header('Set-Cookie', '%s=%s; Path=/; Max-Age=%s; HttpOnly' %
+			(self.SESSION_COOKIE, self.make_session_token(userid, username), self.SESSION_MAX_AGE))
+
 	def reset_cookie(self, cookie):
 		self.response.headers.add_header('Set-Cookie', '%s=; Path=/' % cookie)
 		
@@ -72,7 +248,7 @@ class Handler(webapp2.RequestHandler):
 		return self.generate_pwhash(password, salt) == pwhash
 		
 	def retrieve_title_from_url(self, url):
-		return url.replace('http://dbpedia.org/resource/', '').replace('_', ' ')
+		return retrieve_title_from_url(url)
 	
 	def encode_title(self, title):
-		return title.replace(' ', '_')
\ No newline at end of file
+		return encode_title(title)
\ No newline at end of file
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Janko Hoener
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A single-file bundle of the labels and aliases of Wikidata properties
+and of their BM25 index.
+
+Layout, all integers are little-endian uint32:
+  header      magic 'APB2', property count, string count, term count,
+              posting count
+  properties  per property: pid string, first label, label count
+  order       property numbers sorted by pid
+  terms       per term, sorted by its UTF-8 string: term string, first
+              posting, posting count
+  postings    per posting: property number, BM25 weight as a double
+  offsets     string count + 1 offsets into the string data
+  strings     UTF-8 string data
+
+Labels of a property are consecutive strings, its first label is the
+main one. The bundle is read through mmap where available, so opening it
+does not parse it, lookups binary search it in place and processes
+reading the same file share its pages.
+
+To build a bundle from the text files in wikidata-properties, run
+  python propertybundle.py ../wikidata-properties data/properties.bundle
+"""
+import bisect
+import math
+import os
+import struct
+import sys
+
+try:
+	import mmap
+except ImportError:
+	mmap = None
+
+MAGIC = 'APB2'
+HEADER = struct.Struct('<4sIIII')
+PROPERTY = struct.Struct('<III')
+TERM = struct.Struct('<III')
+POSTING = struct.Struct('<Id')
+UINT = struct.Struct('<I')
+BUNDLE_PATH = os.environ.get('PROPERTY_BUNDLE_PATH',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'properties.bundle'))
+# The BM25 parameters of Lucene.
+K1 = 1.2
+B = 0.75
+
+def weigh(token_lists):
+	"""Returns the BM25 postings of documents given as lists of tokens: a
+	dict from every token to its (document, weight) pairs."""
+	lengths = []
+	frequencies = []
+	for tokens in token_lists:
+		counts = {}
+		for token in tokens:
+			counts[token] = counts.get(token, 0) + 1
+		lengths.append(len(tokens))
+		frequencies.append(counts)
+	ndocs = len(lengths)
+	avglength = float(sum(lengths)) / ndocs if ndocs else 0.0
+	docfreq = {}
+	for counts in frequencies:
+		for token in counts:
+			docfreq[token] = docfreq.get(token, 0) + 1
+	postings = {}
+	for doc, counts in enumerate(frequencies):
+		norm = K1 * (1 - B + B * lengths[doc] / avglength)
+		for token, tf in counts.items():
+			idf = math.log(1 + (ndocs - docfreq[token] + 0.5) / (docfreq[token] + 0.5))
+			weight = idf * tf * (K1 + 1) / (tf + norm)
+			postings.setdefault(token, []).append((doc, weight))
+	return postings
+
+def utf8(s):
+	return s.encode('utf-8') if isinstance(s, unicode) else s
+
+def write_bundle(properties, path, tokenize):
+	"""Writes (property id, labels) pairs to a bundle at path.
+
+	tokenize turns a label into its normalized tokens.
+	"""
+	write_documents(((pid, labels, [t for label in labels for t in tokenize(label)])
+		for pid, labels in properties), path)
+
+def write_documents(documents, path):
+	"""Writes (property id, labels, tokens) triples to a bundle at path."""
+	strings = []
+	string_ids = {}
+
+	def string_id(s):
+		s = utf8(s)
+		if s not in string_ids:
+			string_ids[s] = len(strings)
+			strings.append(s)
+		return string_ids[s]
+
+	records = []
+	pids = []
+	token_lists = []
+	for pid, labels, tokens in documents:
+		# Labels are stored consecutively, so they are not deduplicated.
+		label_start = len(strings)
+		strings.extend(utf8(label) for label in labels)
+		records.append((string_id(pid), label_start, len(labels)))
+		pids.append(utf8(pid))
+		token_lists.append(tokens)
+	order = sorted(range(len(pids)), key = lambda i: pids[i])
+	terms = []
+	postings = []
+	for term, term_postings in sorted((utf8(t), p) for t, p in weigh(token_lists).iteritems()):
+		terms.append((string_id(term), len(postings), len(term_postings)))
+		postings.extend(term_postings)
+	tmppath = path + '.tmp'
+	with open(tmppath, 'wb') as f:
+		f.write(HEADER.pack(MAGIC, len(records), len(strings), len(terms), len(postings)))
+		for record in records:
+			f.write(PROPERTY.pack(*record))
+		f.write(struct.pack('<%sI' % len(order), *order))
+		for term in terms:
+			f.write(TERM.pack(*term))
+		for posting in postings:
+			f.write(POSTING.pack(*posting))
+		offset = 0
+		offsets = [0]
+		for s in strings:
+			offset += len(s)
+			offsets.append(offset)
+		f.write(struct.pack('<%sI' % len(offsets), *offsets))
+		f.write(''.join(strings))
+	os.rename(tmppath, path)
+
+class PropertyBundle(object):
+	"""Read-only access to a property bundle without parsing all of it."""
+	def __init__(self, path = BUNDLE_PATH):
+		self.path = path
+		with open(path, 'rb') as f:
+			if mmap is not None:
+				self.data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+			else:
+				self.data = f.read()
+		magic, self.nprops, self.nstrings, self.nterms, self.npostings = HEADER.unpack_from(self.data, 0)
+		if magic != MAGIC:
+			raise ValueError('%s is not a property bundle of this version, build it again' % path)
+		self.props_offset = HEADER.size
+		self.order_offset = self.props_offset + self.nprops * PROPERTY.size
+		self.terms_offset = self.order_offset + self.nprops * UINT.size
+		self.postings_offset = self.terms_offset + self.nterms * TERM.size
+		self.offsets_offset = self.postings_offset + self.npostings * POSTING.size
+		self.strings_offset = self.offsets_offset + (self.nstrings + 1) * UINT.size
+
+	def raw_string(self, sid):
+		start, end = struct.unpack_from('<II', self.data, self.offsets_offset + sid * UINT.size)
+		return self.data[self.strings_offset + start:self.strings_offset + end]
+
+	def string(self, sid):
+		return self.raw_string(sid).decode('utf-8')
+
+	def record(self, i):
+		return PROPERTY.unpack_from(self.data, self.props_offset + i * PROPERTY.size)
+
+	def pid(self, i):
+		return self.string(self.record(i)[0])
+
+	def labels(self, i):
+		pid_sid, label_start, label_count = self.record(i)
+		return [self.string(sid) for sid in xrange(label_start, label_start + label_count)]
+
+	def find(self, pid):
+		"""Returns the number of the property pid, or None."""
+		order = SortedView(self.nprops, lambda n: self.raw_string(self.record(self.ordered(n))[0]))
+		n = order.find(utf8(pid))
+		return None if n is None else self.ordered(n)
+
+	def ordered(self, n):
+		return UINT.unpack_from(self.data, self.order_offset + n * UINT.size)[0]
+
+	def term(self, n):
+		return TERM.unpack_from(self.data, self.terms_offset + n * TERM.size)
+
+	def postings(self, token):
+		"""Returns the (property number, weight) pairs of token."""
+		terms = SortedView(self.nterms, lambda n: self.raw_string(self.term(n)[0]))
+		n = terms.find(utf8(token))
+		if n is None:
+			return ()
+		sid, first, count = self.term(n)
+		values = struct.unpack_from('<' + 'Id' * count, self.data, self.postings_offset + first * POSTING.size)
+		return zip(values[::2], values[1::2])
+
+	def __len__(self):
+		return self.nprops
+
+	def __iter__(self):
+		"""Yields (property id, labels) for every property."""
+		for i in xrange(self.nprops):
+			yield self.pid(i), self.labels(i)
+
+class SortedView(object):
+	"""A sorted sequence of n keys read by key(i), for bisect."""
+	def __init__(self, n, key):
+		self.n = n
+		self.key = key
+
+	def __len__(self):
+		return self.n
+
+	def __getitem__(self, i):
+		return self.key(i)
+
+	def find(self, key):
+		"""Returns the position of key, or None."""
+		i = bisect.bisect_left(self, key)
+		if i < self.n and self.key(i) == key:
+			return i
+		return None
+
+if __name__ == '__main__':
+	from relationlinker import read_property_files, tokenize
+	if len(sys.argv) != 3:
+		sys.exit('Usage: python propertybundle.py <properties directory> <bundle file>')
+	write_bundle(read_property_files(sys.argv[1]), sys.argv[2], tokenize)
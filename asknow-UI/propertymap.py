@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Janko Hoener
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import os
+
+MAPPING_PATH = os.environ.get('PROPERTY_MAPPING_PATH',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'property_mapping.tsv'))
+
+class PropertyMapping(object):
+	"""Maps DBpedia properties to Wikidata property ids and back.
+
+	The mapping is read from the tab-separated file written by
+	link_wikidata_asknow.py, one DBpedia property URI and Wikidata property
+	id per line.
+	"""
+	def __init__(self, path = MAPPING_PATH):
+		self.path = path
+		self.wikidata = {}
+		self.dbpedia = {}
+		if not os.path.exists(path):
+			logging.warning('Property mapping %s does not exist, no DBpedia property will be mapped. '
+				'Write it with link_wikidata_asknow.py.' % path)
+			return
+		with open(path) as f:
+			for line in f:
+				fields = line.rstrip('\n').split('\t')
+				if len(fields) != 2:
+					continue
+				dbpurl, pid = fields
+				self.wikidata.setdefault(dbpurl, pid)
+				self.dbpedia.setdefault(pid, []).append(dbpurl)
+		logging.info('Loaded %s property mappings from %s' % (len(self.wikidata), path))
+
+	def to_wikidata(self, dbpurl):
+		"""Returns the Wikidata property id of a DBpedia property, or None."""
+		return self.wikidata.get(dbpurl)
+
+	def to_dbpedia(self, pid):
+		"""Returns the DBpedia properties equivalent to a Wikidata property."""
+		return self.dbpedia.get(pid, [])
+
+	def __len__(self):
+		return len(self.wikidata)
+
+property_mapping = PropertyMapping()
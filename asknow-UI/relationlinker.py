@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Janko Hoener
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import heapq
+import logging
+import os
+import re
+import threading
+import time
+from propertybundle import PropertyBundle, weigh, BUNDLE_PATH
+
+PROPERTIES_PATH = os.environ.get('PROPERTIES_PATH',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'wikidata-properties'))
+# The English stopwords of Lucene's StandardAnalyzer.
+STOPWORDS = frozenset([u'a', u'an', u'and', u'are', u'as', u'at', u'be', u'but', u'by',
+	u'for', u'if', u'in', u'into', u'is', u'it', u'no', u'not', u'of', u'on', u'or',
+	u'such', u'that', u'the', u'their', u'then', u'there', u'these', u'they', u'this',
+	u'to', u'was', u'will', u'with'])
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+# The kinds of matches of RelationIndex.link.
+BM25 = 'bm25'
+FUZZY = 'fuzzy'
+
+def tokenize(text):
+	if isinstance(text, str):
+		text = text.decode('utf-8', 'replace')
+	return [t for t in TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
+
+def squash(text):
+	# Lowercase word characters only, so 'birth place' matches 'birthplace'.
+	if isinstance(text, str):
+		text = text.decode('utf-8', 'replace')
+	return u''.join(TOKEN_RE.findall(text.lower()))
+
+def trigrams(text):
+	padded = u'  %s ' % text
+	return set(padded[i:i + 3] for i in xrange(len(padded) - 2))
+
+def bounded_distance(a, b, bound):
+	"""Returns the edit distance of a and b, counting a transposition of
+	adjacent characters as one edit, or bound + 1 if it exceeds bound.
+
+	Only the cells within bound of the diagonal are computed.
+	"""
+	if abs(len(a) - len(b)) > bound:
+		return bound + 1
+	over = bound + 1
+	prevprev = None
+	prev = range(len(b) + 1)
+	for i in xrange(1, len(a) + 1):
+		cur = [over] * (len(b) + 1)
+		if i <= bound:
+			cur[0] = i
+		lowest = cur[0]
+		for j in xrange(max(1, i - bound), min(len(b), i + bound) + 1):
+			distance = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (a[i - 1] != b[j - 1]))
+			if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+				distance = min(distance, prevprev[j - 2] + 1)
+			cur[j] = distance
+			if distance < lowest:
+				lowest = distance
+		if lowest > bound:
+			return over
+		prevprev, prev = prev, cur
+	return min(prev[-1], over)
+
+def read_property_files(path = PROPERTIES_PATH, filenames = None):
+	"""Yields (property id, labels) for every P*.txt file in path, or for
+	filenames in path."""
+	for filename in sorted(filenames or os.listdir(path)):
+		if not filename.endswith('.txt'):
+			continue
+		with open(os.path.join(path, filename)) as f:
+			labels = [line.strip().decode('utf-8', 'replace') for line in f]
+		yield filename[:-len('.txt')], [label for label in labels if label]
+
+class RelationIndex(object):
+	"""An inverted index with BM25 scoring over Wikidata property labels.
+
+	Every property is one document made of the tokens of its label and
+	aliases. The BM25 weight of each posting is computed when the index is
+	built, so a search only adds up the weights of the postings of its
+	terms.
+	"""
+	def __init__(self, documents):
+		"""documents yields (property id, labels, tokens) triples."""
+		self.pids = []
+		self.names = []
+		token_lists = []
+		for pid, labels, tokens in documents:
+			self.pids.append(pid)
+			self.names.append(labels)
+			token_lists.append(tokens)
+		self.postings = weigh(token_lists)
+		self.docs = dict((pid, doc) for doc, pid in enumerate(self.pids))
+		self.trigram_index = None
+		self.lock = threading.Lock()
+
+	@classmethod
+	def from_properties(cls, properties):
+		"""Builds the index from (property id, labels) pairs."""
+		return cls((pid, labels, [t for label in labels for t in tokenize(label)])
+			for pid, labels in properties)
+
+	@classmethod
+	def from_directory(cls, path = PROPERTIES_PATH):
+		start = time.time()
+		index = cls.from_properties(read_property_files(path))
+		logging.info('Indexed %s properties from %s in %.2fs' % (len(index), path, time.time() - start))
+		return index
+
+	@classmethod
+	def from_bundle(cls, path = BUNDLE_PATH):
+		"""Returns the index stored in the property bundle at path, which is
+		searched in place."""
+		return BundleRelationIndex(PropertyBundle(path))
+
+	def term_postings(self, token):
+		return self.postings.get(token, ())
+
+	def pid(self, doc):
+		return self.pids[doc]
+
+	def label(self, pid):
+		names = self.names[self.docs[pid]]
+		return names[0] if names else pid
+
+	def all_labels(self):
+		"""Yields (document, label) for the labels of all properties."""
+		for doc, labels in enumerate(self.names):
+			for label in labels:
+				yield doc, label
+
+	def search(self, phrase, k = 5):
+		"""Returns the top k (property id, score) pairs for phrase."""
+		scores = {}
+		for token in tokenize(phrase):
+			for doc, weight in self.term_postings(token):
+				scores[doc] = scores.get(doc, 0.0) + weight
+		best = heapq.nlargest(k, scores.iteritems(), key = lambda item: item[1])
+		return [(self.pid(doc), score) for doc, score in best]
+
+	def fuzzy_search(self, phrase, k = 5, max_distance = None):
+		"""Returns the top k (property id, score) pairs for phrase, allowing
+		for typos. The score is the similarity of the closest label, 1.0 for
+		an exact match."""
+		if self.trigram_index is None:
+			with self.lock:
+				if self.trigram_index is None:
+					self.trigram_index = TrigramIndex(self.all_labels())
+		best = self.trigram_index.search(phrase, k, max_distance)
+		return [(self.pid(doc), score) for doc, score in best]
+
+	def link(self, phrase, k = 5):
+		"""Returns the top k (property id, score, match) triples for phrase,
+		falling back to fuzzy matching if a token of phrase is in no label.
+
+		match tells the scales of the scores apart: BM25 scores of search,
+		which are unbounded, or FUZZY similarities of fuzzy_search, from 0
+		to 1.
+		"""
+		tokens = tokenize(phrase)
+		if tokens and all(self.term_postings(token) for token in tokens):
+			return [(pid, score, BM25) for pid, score in self.search(phrase, k)]
+		return [(pid, score, FUZZY) for pid, score in self.fuzzy_search(phrase, k)]
+
+	def __len__(self):
+		return len(self.pids)
+
+class BundleRelationIndex(RelationIndex):
+	"""A RelationIndex searched in place in a property bundle, so it loads
+	at once and processes share it. Only the trigram index of fuzzy_search
+	is built in memory, on the first lookup with a typo."""
+	def __init__(self, bundle):
+		self.bundle = bundle
+		self.trigram_index = None
+		self.lock = threading.Lock()
+
+	def term_postings(self, token):
+		return self.bundle.postings(token)
+
+	def pid(self, doc):
+		return self.bundle.pid(doc)
+
+	def label(self, pid):
+		doc = self.bundle.find(pid)
+		if doc is None:
+			raise KeyError(pid)
+		names = self.bundle.labels(doc)
+		return names[0] if names else pid
+
+	def all_labels(self):
+		for doc in xrange(len(self.bundle)):
+			for label in self.bundle.labels(doc):
+				yield doc, label
+
+	def __len__(self):
+		return len(self.bundle)
+
+class TrigramIndex(object):
+	"""A character trigram index for typo-tolerant label lookups.
+
+	Labels sharing the most trigrams with the query are the candidates,
+	only those are compared by their bounded edit distance to the query.
+	An edit changes at most four trigrams, so labels sharing fewer are
+	dropped without comparing them.
+	"""
+	MAX_CANDIDATES = 30
+
+	def __init__(self, labels):
+		"""labels yields (document, label) pairs."""
+		self.docs = []
+		self.strings = []
+		self.postings = {}
+		seen = set()
+		for doc, label in labels:
+			string = squash(label)
+			if not string or (doc, string) in seen:
+				continue
+			seen.add((doc, string))
+			lid = len(self.strings)
+			self.docs.append(doc)
+			self.strings.append(string)
+			for gram in trigrams(string):
+				self.postings.setdefault(gram, []).append(lid)
+
+	def search(self, phrase, k = 5, max_distance = None):
+		"""Returns the top k (document, score) pairs for phrase."""
+		string = squash(phrase)
+		if not string:
+			return []
+		if max_distance is None:
+			max_distance = max(1, len(string) // 4)
+		grams = trigrams(string)
+		shared = {}
+		for gram in grams:
+			for lid in self.postings.get(gram, ()):
+				shared[lid] = shared.get(lid, 0) + 1
+		minimum = len(grams) - 4 * max_distance
+		candidates = heapq.nlargest(self.MAX_CANDIDATES,
+			((lid, count) for lid, count in shared.iteritems() if count >= minimum),
+			key = lambda item: item[1])
+		best = {}
+		for lid, count in candidates:
+			label = self.strings[lid]
+			distance = bounded_distance(string, label, max_distance)
+			if distance > max_distance:
+				continue
+			score = 1.0 - float(distance) / max(len(string), len(label))
+			doc = self.docs[lid]
+			if score > best.get(doc, 0.0):
+				best[doc] = score
+		return heapq.nlargest(k, best.iteritems(), key = lambda item: item[1])
+
+_relation_index = None
+_relation_index_lock = threading.Lock()
+
+def get_relation_index():
+	"""Returns the relation index of this instance, opening it on first use.
+
+	The index is read from the property bundle if there is one, and built
+	from the property files otherwise.
+	"""
+	global _relation_index
+	if _relation_index is None:
+		with _relation_index_lock:
+			if _relation_index is None:
+				if os.path.exists(BUNDLE_PATH):
+					_relation_index = RelationIndex.from_bundle()
+				else:
+					_relation_index = RelationIndex.from_directory()
+	return _relation_index
+
+
+if __name__ == '__main__':
+	# Compares the latency of exact and fuzzy lookups, e.g.
+	#   python relationlinker.py "birth place" brithplace "popluation"
+	import sys
+	phrases = sys.argv[1:] or ['birth place', 'birthplace', 'brithplace', 'place of brith', 'populaton', 'capital']
+	index = get_relation_index()
+	index.fuzzy_search('')
+	runs = 200
+	for phrase in phrases:
+		timings = []
+		for lookup in (index.search, index.fuzzy_search):
+			start = time.time()
+			for _ in xrange(runs):
+				result = lookup(phrase)
+			timings.append((time.time() - start) * 1000.0 / runs)
+			timings.append(result[0][0] if result else None)
+		print '%-20s exact %.3fms %-6s fuzzy %.3fms %s' % tuple([phrase] + timings)
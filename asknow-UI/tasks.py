@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Janko Hoener
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import collections
+import datetime
+import json
+import logging
+from handlerlib import Handler
+from datatypes import AskNowQuestion
+from answerlib import answer_service
+from answerstore import normalize_question
+
+def popular_questions(since, n, limit = 20000):
+	"""Returns the n questions asked most often since the given datetime,
+	most popular first.
+
+	Questions are counted by their normalized form, the most recent
+	wording of each is returned. At most limit questions are read.
+	"""
+	query = AskNowQuestion.query(AskNowQuestion.asked >= since).order(-AskNowQuestion.asked)
+	counts = collections.Counter()
+	wordings = {}
+	for res in query.iter(limit = limit, batch_size = 500, projection = [AskNowQuestion.asked, AskNowQuestion.question]):
+		key = normalize_question(res.question)
+		if not key:
+			continue
+		counts[key] += 1
+		wordings.setdefault(key, res.question)
+	return [wordings[key] for key, count in counts.most_common(n)]
+
+class AskNowWarmUpHandler(Handler):
+	"""Refreshes the cached entities and Genesis information of the
+	questions asked most in the last WINDOW, see cron.yaml.
+
+	The job runs more often than the shortest Genesis cache TTL, so the
+	popular questions are answered from the caches.
+	"""
+	WINDOW = datetime.timedelta(days = 7)
+	TOP_QUESTIONS = 50
+	MAX_WORKERS = 5
+
+	def get(self):
+		since = datetime.datetime.utcnow() - self.WINDOW
+		questions = popular_questions(since, self.TOP_QUESTIONS)
+		logging.info('Warming up the caches for %s popular questions.' % len(questions))
+		entities, results = answer_service.warm_up(questions, self.MAX_WORKERS)
+		logging.info('Refreshed %s entities and %s Genesis results.' % (entities, results))
+		self.response.headers['Content-Type'] = 'application/json; charset=UTF-8'
+		self.write(json.dumps({'questions': len(questions), 'entities': entities, 'results': results}))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Janko Hoener
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import logging
+import Queue
+import tracelib
+
+def parallel_map(func, items, max_workers = 5):
+	"""Calls func for every item on at most max_workers threads.
+
+	Returns the results in the order of items. If func raises, the
+	exception is logged and the result is None.
+	"""
+	items = list(items)
+	func = tracelib.bind(func)
+	results = [None] * len(items)
+	queue = Queue.Queue()
+	for i, item in enumerate(items):
+		queue.put((i, item))
+
+	def worker():
+		while True:
+			try:
+				i, item = queue.get_nowait()
+			except Queue.Empty:
+				return
+			try:
+				results[i] = func(item)
+			except Exception:
+				logging.exception('Worker failed for %s' % (item,))
+
+	if len(items) == 1:
+		worker()
+		return results
+	threads = [threading.Thread(target = worker) for _ in range(min(max_workers, len(items)))]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return results
+
+def imap_unordered(func, items, max_workers = 5):
+	"""Calls func for every item on at most max_workers threads.
+
+	Yields the results as soon as they are ready, in no particular order.
+	At most max_workers results are buffered, so a slow consumer holds
+	back the workers instead of piling up results in memory.
+	"""
+	items = list(items)
+	func = tracelib.bind(func)
+	tasks = Queue.Queue()
+	for item in items:
+		tasks.put(item)
+	results = Queue.Queue(max_workers)
+	stop = threading.Event()
+
+	def worker():
+		while not stop.is_set():
+			try:
+				item = tasks.get_nowait()
+			except Queue.Empty:
+				return
+			try:
+				result = func(item)
+			except Exception:
+				logging.exception('Worker failed for %s' % (item,))
+				result = None
+			while not stop.is_set():
+				try:
+					results.put(result, timeout = 1)
+					break
+				except Queue.Full:
+					pass
+
+	threads = [threading.Thread(target = worker) for _ in range(min(max_workers, len(items)))]
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+	try:
+		for _ in items:
+			yield results.get()
+	finally:
+		stop.set()
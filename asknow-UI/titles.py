@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Janko Hoener
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""DBpedia titles, without dependencies, so the offline index builders can
+use them too."""
+
+def retrieve_title_from_url(url):
+	return url.replace('http://dbpedia.org/resource/', '').replace('_', ' ')
+
+def encode_title(title):
+	return title.replace(' ', '_')
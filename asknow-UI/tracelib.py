@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Janko Hoener
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Timing of the steps of a request.
+
+A span times one step, e.g. an upstream fetch. Its duration is added to
+the trace of the current request, which is sent in the Server-Timing
+header, and to the latency histogram of its name in this instance.
+"""
+import bisect
+import collections
+import contextlib
+import re
+import threading
+import time
+
+# Upper bounds of the histogram buckets in milliseconds.
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+
+class Histogram(object):
+	"""Counts durations in buckets growing exponentially, so percentiles
+	are estimated in constant memory."""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counts = [0] * (len(BUCKETS) + 1)
+		self.count = 0
+		self.total = 0.0
+		self.maximum = 0.0
+
+	def add(self, ms):
+		with self.lock:
+			self.counts[bisect.bisect_left(BUCKETS, ms)] += 1
+			self.count = self.count + 1
+			self.total = self.total + ms
+			self.maximum = max(self.maximum, ms)
+
+	def percentile(self, p):
+		# Returns the upper bound of the bucket of the pth percentile, at most
+		# the largest duration.
+		with self.lock:
+			rank = p / 100.0 * self.count
+			seen = 0
+			for i, count in enumerate(self.counts):
+				seen = seen + count
+				if count and seen >= rank:
+					return min(BUCKETS[i], self.maximum) if i < len(BUCKETS) else self.maximum
+		return None
+
+	def stats(self):
+		return {
+			'count': self.count,
+			'mean': self.total / self.count if self.count else None,
+			'max': self.maximum,
+			'p50': self.percentile(50),
+			'p95': self.percentile(95),
+			'p99': self.percentile(99),
+			'buckets': dict(('le_%s' % bound, count) for bound, count in zip(BUCKETS + ['inf'], self.counts)),
+		}
+
+histograms = collections.defaultdict(Histogram)
+histograms_lock = threading.Lock()
+
+def histogram(name):
+	with histograms_lock:
+		return histograms[name]
+
+def histogram_stats():
+	with histograms_lock:
+		items = histograms.items()
+	return dict((name, h.stats()) for name, h in items)
+
+class Trace(object):
+	"""The spans of one request, in the order they ended."""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.spans = []
+		self.started = time.time()
+
+	def add(self, name, ms, retries = 0):
+		with self.lock:
+			self.spans.append((name, ms, retries))
+
+	def server_timing(self):
+		"""Returns the value of the Server-Timing header.
+
+		Spans of the same name are summed up, their count and retries are
+		the description.
+		"""
+		totals = collections.OrderedDict()
+		with self.lock:
+			for name, ms, retries in self.spans:
+				total = totals.setdefault(name, [0.0, 0, 0])
+				total[0] += ms
+				total[1] += 1
+				total[2] += retries
+		metrics = []
+		for name, (ms, count, retries) in totals.items():
+			desc = '%s calls' % count if count > 1 else ''
+			if retries:
+				desc = ('%s, %s retries' % (desc, retries)).lstrip(', ')
+			metric = '%s;dur=%.1f' % (re.sub(r'[^\w.-]', '_', name), ms)
+			if desc:
+				metric = '%s;desc="%s"' % (metric, desc)
+			metrics.append(metric)
+		return ', '.join(metrics)
+
+local = threading.local()
+
+def current():
+	"""Returns the trace of the request handled by this thread, or None."""
+	return getattr(local, 'trace', None)
+
+def start_trace():
+	local.trace = Trace()
+	return local.trace
+
+def end_trace():
+	trace = current()
+	local.trace = None
+	return trace
+
+def bind(func):
+	"""Returns func running in the trace of the calling thread, for calls
+	on other threads."""
+	trace = current()
+
+	def call(*args, **kw):
+		previous = current()
+		local.trace = trace
+		try:
+			return func(*args, **kw)
+		finally:
+			local.trace = previous
+	return call
+
+def record(name, seconds, retries = 0, trace = None):
+	"""Records a span of name that took seconds, in trace or in the trace
+	of this thread."""
+	ms = seconds * 1000.0
+	histogram(name).add(ms)
+	trace = trace or current()
+	if trace is not None:
+		trace.add(name, ms, retries)
+
+@contextlib.contextmanager
+def span(name):
+	start = time.time()
+	try:
+		yield
+	finally:
+		record(name, time.time() - start)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Janko Hoener
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import random
+import threading
+import time
+import backends
+import tracelib
+
+class CircuitBreaker(object):
+	"""Stops calling an upstream after failure_threshold failures in a row.
+
+	After reset_timeout seconds a single probe is let through. If it
+	succeeds the breaker closes again, otherwise it stays open. A probe
+	whose result is never recorded, e.g. because its caller went away, is
+	replaced by another one after reset_timeout seconds.
+	"""
+	CLOSED = 'closed'
+	OPEN = 'open'
+	HALF_OPEN = 'half-open'
+
+	def __init__(self, name, failure_threshold = 5, reset_timeout = 30):
+		self.name = name
+		self.failure_threshold = failure_threshold
+		self.reset_timeout = reset_timeout
+		self.lock = threading.Lock()
+		self.state = self.CLOSED
+		self.failures = 0
+		self.opened = 0
+		self.probe_started = 0
+
+	def allow(self):
+		with self.lock:
+			if self.state == self.CLOSED:
+				return True
+			now = time.time()
+			if self.state == self.OPEN and now - self.opened >= self.reset_timeout:
+				self.state = self.HALF_OPEN
+				self.probe_started = now
+				return True
+			if self.state == self.HALF_OPEN and now - self.probe_started >= self.reset_timeout:
+				self.probe_started = now
+				return True
+			return False
+
+	def record_success(self):
+		with self.lock:
+			self.state = self.CLOSED
+			self.failures = 0
+
+	def record_failure(self):
+		with self.lock:
+			self.failures = self.failures + 1
+			if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+				if self.state != self.OPEN:
+					logging.warning('Circuit breaker for %s opened after %s failures' % (self.name, self.failures))
+				self.state = self.OPEN
+				self.opened = time.time()
+
+class UpstreamCall(object):
+	"""An asynchronous request to an upstream, see Upstream.make_call."""
+	def __init__(self, upstream, rpc, span = None, retries = 0, deadline = None):
+		self.upstream = upstream
+		self.rpc = rpc
+		self.deadline = deadline
+		self.started = time.time()
+		self.span = span or upstream.name
+		self.retries = retries
+		# The result may be waited for after the request handler returned.
+		self.trace = tracelib.current()
+
+	def record(self, success):
+		elapsed = time.time() - self.started
+		self.upstream.record(success, elapsed, self.deadline)
+		tracelib.record(self.span, elapsed, self.retries, self.trace)
+
+	def get_result(self):
+		"""Returns the response, or None if the request failed."""
+		try:
+			urlobj = self.rpc.get_result()
+		except Exception:
+			self.record(False)
+			return None
+		self.record(urlobj.status_code < 500)
+		return urlobj
+
+class Upstream(object):
+	"""The client for one upstream service, shared by all requests.
+
+	Every upstream has a circuit breaker, so calls to a dead upstream
+	fail at once instead of waiting for their deadlines. Retries are
+	limited by a budget that grows by retry_ratio per request, and they
+	are spread by a jittered backoff. The deadline adapts to the observed
+	latency, between min_deadline and max_deadline.
+
+	urlfetch reuses connections to the same host by itself, so requests
+	are made with keep-alive.
+	"""
+	TIMEOUT_RATIO = 0.95 # of the deadline a failure took to count as a timeout
+	TIMEOUT_GROWTH = 2
+
+	def __init__(self, name, deadline = 1, min_deadline = 0.5, max_deadline = 5, retries = 2,
+			retry_ratio = 0.2, backoff = 0.05, failure_threshold = 5, reset_timeout = 30):
+		self.name = name
+		self.min_deadline = min_deadline
+		self.max_deadline = max_deadline
+		self.retries = retries
+		self.retry_ratio = retry_ratio
+		self.max_retry_budget = 10.0
+		self.backoff = backoff
+		self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+		self.lock = threading.Lock()
+		self.retry_budget = self.max_retry_budget
+		self.latency = None
+		self.deviation = 0.0
+		self.initial_deadline = deadline
+
+	def deadline(self):
+		"""Returns the deadline for the next request.
+
+		It is the smoothed latency plus four times its mean deviation, so
+		slow but working responses are not cut off.
+		"""
+		with self.lock:
+			if self.latency is None:
+				return self.initial_deadline
+			deadline = self.latency + 4 * self.deviation
+		return min(self.max_deadline, max(self.min_deadline, deadline))
+
+	def allow(self):
+		return self.breaker.allow()
+
+	def retry_allowed(self):
+		with self.lock:
+			if self.retry_budget < 1:
+				return False
+			self.retry_budget = self.retry_budget - 1
+			return True
+
+	def observe(self, latency):
+		# Updates the smoothed latency and its mean deviation, the lock must
+		# be held.
+		if self.latency is None:
+			self.latency = latency
+			self.deviation = latency / 2
+		else:
+			self.deviation = 0.75 * self.deviation + 0.25 * abs(latency - self.latency)
+			self.latency = 0.875 * self.latency + 0.125 * latency
+
+	def record(self, success, latency, deadline = None):
+		"""Records a request that took latency seconds.
+
+		A failure that took its deadline timed out, the response would have
+		taken longer. It counts as TIMEOUT_GROWTH times the deadline, so the
+		deadline grows until slow responses fit in it again.
+		"""
+		with self.lock:
+			self.retry_budget = min(self.max_retry_budget, self.retry_budget + self.retry_ratio)
+			if success:
+				self.observe(latency)
+			elif deadline and latency >= deadline * self.TIMEOUT_RATIO:
+				self.observe(max(deadline * self.TIMEOUT_GROWTH, self.latency or 0))
+		if success:
+			self.breaker.record_success()
+		else:
+			self.breaker.record_failure()
+
+	def sleep_before_retry(self, attempt, until = None):
+		# Sleeps for a jittered backoff, but not past the time until.
+		delay = random.uniform(0, self.backoff * 2 ** attempt)
+		if until is not None:
+			delay = min(delay, until - time.time())
+		if delay > 0:
+			time.sleep(delay)
+
+	def make_call(self, url, deadline = None, span = None, retries = 0, **kw):
+		"""Starts an asynchronous request and returns an UpstreamCall, or
+		None if the circuit breaker is open.
+
+		The request is timed as span, or as the name of the upstream, with
+		retries the number of requests made for the same thing before.
+		"""
+		if not self.allow():
+			return None
+		deadline = deadline or self.deadline()
+		try:
+			rpc = backends.fetch.create_rpc(deadline = deadline)
+			backends.fetch.make_fetch_call(rpc, url, **kw)
+		except Exception:
+			self.record(False, 0)
+			raise
+		return UpstreamCall(self, rpc, span, retries, deadline)
+
+	def fetch(self, url, **kw):
+		"""Fetches url, retrying on errors and server errors.
+
+		Returns the last response, or None if there was none, e.g. because
+		the circuit breaker is open. All attempts are timed as one span.
+		"""
+		attempt = 0
+		requests = 0
+		fetch_started = time.time()
+		try:
+			while True:
+				if not self.allow():
+					logging.info('Circuit breaker for %s is open, not fetching %s' % (self.name, url))
+					return None
+				started = time.time()
+				requests = requests + 1
+				deadline = self.deadline()
+				try:
+					urlobj = backends.fetch.fetch(url, deadline = deadline, **kw)
+				except Exception as e:
+					logging.debug('Cannot fetch %s: %s' % (url, e))
+					self.record(False, time.time() - started, deadline)
+					urlobj = None
+				else:
+					success = urlobj.status_code < 500
+					self.record(success, time.time() - started)
+					if success:
+						return urlobj
+				attempt = attempt + 1
+				if attempt >= self.retries or not self.retry_allowed():
+					return urlobj
+				self.sleep_before_retry(attempt)
+		finally:
+			if requests:
+				tracelib.record(self.name, time.time() - fetch_started, requests - 1)
+
+	def stats(self):
+		return {
+			'breaker': self.breaker.state,
+			'deadline': self.deadline(),
+			'latency': self.latency,
+			'retry_budget': self.retry_budget,
+		}
+
+genesis = Upstream('genesis', deadline = 1, max_deadline = 2)
+spotlight = Upstream('spotlight', deadline = 5, min_deadline = 1, max_deadline = 10)
+asknow = Upstream('asknow', deadline = 5, min_deadline = 1, max_deadline = 10)
@@ -20,7 +20,7 @@ import re
 
 class AskNowLogoutHandler(Handler):
 	def get(self):
-		self.reset_cookie('userid')
+		self.reset_cookie(self.SESSION_COOKIE)
 		self.redirect(webapp2.uri_for('demo'))
 		
 class AskNowSignUpHandler(Handler):
@@ -62,7 +62,7 @@ class AskNowSignUpHandler(Handler):
 			newuser = AskNowUser(username = username, password = pwhash, salt = salt, email = email)
 			newkey = newuser.put()
 			newid = newkey.id()
-			self.response.headers.add_header('Set-Cookie', 'userid=%s|%s; Path=/' % (newid, self.hash_str(newid)))
+			self.set_session_cookie(newid, username)
 			self.redirect(webapp2.uri_for('demo'))
 		else:
 			values = {}
@@ -98,7 +98,7 @@ class AskNowLoginHandler(Handler):
 			salt = user.salt
 			if self.verify_password(pwhash, password, salt):
 				userid = user.key.id()
-				self.response.headers.add_header('Set-Cookie', 'userid=%s|%s; Path=/' % (userid, self.hash_str(userid)))
+				self.set_session_cookie(userid, user.username)
 				self.redirect(webapp2.uri_for('demo'))
 			else:
 				self.render_form(error = 'Invalid login')
@@ -0,0 +1,153 @@
+# coding=utf-8
+"""Builds the relation and entity indexes of the AskNow demonstrator on
+all cores.
+
+  python build_indexes.py relations [--properties DIR] [--bundle FILE]
+  python build_indexes.py entities labels_en.ttl.gz [--gazetteer FILE]
+      [--disambiguations disambiguations_en.ttl.gz]
+
+The input is read by the main process and split into chunks: groups of
+property files, or blocks of lines of the gzipped N-Triples dump. A pool
+of worker processes parses, tokenizes and normalizes the chunks into
+partial indexes, which are merged into the property bundle or the
+gazetteer. At most a few chunks per worker are in flight, so the dump is
+streamed and never held in memory as a whole.
+"""
+import argparse
+import collections
+import gzip
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'asknow-UI'))
+from propertybundle import write_documents, BUNDLE_PATH
+from relationlinker import read_property_files, tokenize, PROPERTIES_PATH
+import entitylinker
+
+CHUNK_BYTES = 4 << 20 # uncompressed bytes of N-Triples per chunk
+FILES_PER_CHUNK = 200
+IN_FLIGHT = 2 # chunks per worker
+
+def bounded_imap(pool, func, chunks, workers):
+	"""Like pool.imap, but reads at most IN_FLIGHT chunks per worker ahead
+	of the results."""
+	pending = collections.deque()
+	for chunk in chunks:
+		pending.append(pool.apply_async(func, (chunk,)))
+		if len(pending) >= workers * IN_FLIGHT:
+			yield pending.popleft().get()
+	while pending:
+		yield pending.popleft().get()
+
+def read_blocks(path):
+	"""Yields blocks of whole lines of the gzipped file at path."""
+	f = gzip.open(path, 'rb')
+	try:
+		rest = ''
+		while True:
+			data = f.read(CHUNK_BYTES)
+			if not data:
+				break
+			data = rest + data
+			end = data.rfind('\n') + 1
+			rest = data[end:]
+			if end:
+				yield data[:end]
+		if rest:
+			yield rest
+	finally:
+		f.close()
+
+def tokenize_properties(chunk):
+	# Runs in a worker: the (property id, labels, tokens) of the files of chunk.
+	path, filenames = chunk
+	documents = []
+	for pid, labels in read_property_files(path, filenames):
+		documents.append((pid, labels, [t for label in labels for t in tokenize(label)]))
+	return documents
+
+def build_relations(pool, workers, path = PROPERTIES_PATH, bundle_path = BUNDLE_PATH):
+	filenames = sorted(name for name in os.listdir(path) if name.endswith('.txt'))
+	chunks = [(path, filenames[i:i + FILES_PER_CHUNK]) for i in range(0, len(filenames), FILES_PER_CHUNK)]
+	# The results come in the order of the files, as in propertybundle.py.
+	documents = []
+	for partial in bounded_imap(pool, tokenize_properties, chunks, workers):
+		documents.extend(partial)
+	write_documents(documents, bundle_path)
+	return len(documents)
+
+excluded_subjects = frozenset()
+
+def init_entity_worker(excluded):
+	global excluded_subjects
+	excluded_subjects = excluded
+
+def parse_labels(block):
+	# Runs in a worker: the labels of the triples in block, as filled by
+	# entitylinker.add_label.
+	labels = {}
+	for line in block.split('\n'):
+		triple = entitylinker.parse_triple(line)
+		if triple is None:
+			continue
+		entry = entitylinker.parse_label(triple, excluded_subjects)
+		if entry is not None:
+			label, title = entry
+			entitylinker.add_label(labels, tuple(entitylinker.tokenize(label)), title)
+	return labels
+
+def parse_subjects(block):
+	# Runs in a worker: the subjects of the triples in block.
+	subjects = set()
+	for line in block.split('\n'):
+		triple = entitylinker.parse_triple(line)
+		if triple is not None:
+			subjects.add(triple[0])
+	return subjects
+
+def read_subjects(pool, workers, path):
+	subjects = set()
+	for partial in bounded_imap(pool, parse_subjects, read_blocks(path), workers):
+		subjects.update(partial)
+	return frozenset(subjects)
+
+def build_entities(workers, labels_path, gazetteer_path = entitylinker.GAZETTEER_PATH, disambiguations = None):
+	excluded = frozenset()
+	if disambiguations:
+		pool = multiprocessing.Pool(workers)
+		excluded = read_subjects(pool, workers, disambiguations)
+		pool.close()
+		print '%s disambiguation pages left out.' % len(excluded)
+	# The excluded subjects are passed on once per worker, not per chunk.
+	pool = multiprocessing.Pool(workers, init_entity_worker, (excluded,))
+	labels = {}
+	for partial in bounded_imap(pool, parse_labels, read_blocks(labels_path), workers):
+		entitylinker.merge_labels(labels, partial)
+	pool.close()
+	gazetteer = entitylinker.Gazetteer.from_labels(labels)
+	gazetteer.save(gazetteer_path)
+	return len(gazetteer)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--workers', type = int, default = multiprocessing.cpu_count())
+	subparsers = parser.add_subparsers(dest = 'index')
+	relations = subparsers.add_parser('relations', help = 'build the property bundle from property files')
+	relations.add_argument('--properties', default = PROPERTIES_PATH, help = 'directory of P*.txt files')
+	relations.add_argument('--bundle', default = BUNDLE_PATH)
+	entities = subparsers.add_parser('entities', help = 'build the gazetteer from a label dump')
+	entities.add_argument('labels', help = 'gzipped N-Triples file of rdfs:label triples')
+	entities.add_argument('--gazetteer', default = entitylinker.GAZETTEER_PATH)
+	entities.add_argument('--disambiguations', help = 'gzipped N-Triples file whose subjects are left out')
+	args = parser.parse_args()
+	start = time.time()
+	if args.index == 'relations':
+		pool = multiprocessing.Pool(args.workers)
+		count = build_relations(pool, args.workers, args.properties, args.bundle)
+		pool.close()
+		print 'Wrote %s properties to %s in %.1fs.' % (count, args.bundle, time.time() - start)
+	else:
+		count = build_entities(args.workers, args.labels, args.gazetteer, args.disambiguations)
+		print 'Wrote %s entities to %s in %.1fs.' % (count, args.gazetteer, time.time() - start)
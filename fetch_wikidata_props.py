@@ -1,35 +1,240 @@
 # coding=utf-8
-import urllib, urllib2
+"""Fetches the labels and aliases of all Wikidata properties into a bundle.
+
+Property titles are listed page by page, and their terms are then fetched
+in batches by several workers, each reusing one connection. Progress is
+kept in a state file, so an interrupted run resumes where it stopped.
+With --incremental, only the properties changed since the last completed
+run are fetched and merged into the existing bundle.
+"""
+import argparse
+import datetime
+import httplib
 import json
+import os
+import Queue
+import socket
+import sys
+import threading
+import time
+import urllib
+import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'asknow-UI'))
+from propertybundle import PropertyBundle, write_bundle, BUNDLE_PATH
+from relationlinker import tokenize
+
+WIKIDATA_API_URL = 'https://www.wikidata.org/w/api.php'
+PROPERTY_NAMESPACE = 120
+BATCH_SIZE = 50 # maximum number of titles per pageterms query
+RETRIES = 3
+SAVE_INTERVAL = 5 # seconds between checkpoints while fetching
+# Wikidata only keeps recent changes for 30 days.
+MAX_INCREMENTAL_AGE = datetime.timedelta(days = 28)
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+class WikidataConnection(object):
+	"""A persistent connection to the Wikidata API."""
+	def __init__(self, api_url = WIKIDATA_API_URL, timeout = 30):
+		parts = urlparse.urlsplit(api_url)
+		self.path = parts.path
+		if parts.scheme == 'https':
+			self.conn = httplib.HTTPSConnection(parts.netloc, timeout = timeout)
+		else:
+			self.conn = httplib.HTTPConnection(parts.netloc, timeout = timeout)
+
+	def query(self, param):
+		param = dict(param)
+		param['action'] = 'query'
+		param['format'] = 'json'
+		url = self.path + '?' + urllib.urlencode(param)
+		headers = {'User-Agent': 'asknow-UI fetch_wikidata_props', 'Connection': 'keep-alive'}
+		for attempt in range(RETRIES):
+			try:
+				self.conn.request('GET', url, headers = headers)
+				urlobj = self.conn.getresponse()
+				content = urlobj.read()
+			except (httplib.HTTPException, socket.error) as e:
+				# The connection is opened again by the next request.
+				self.conn.close()
+				error = e
+			else:
+				if urlobj.status == 200:
+					return json.loads(content)
+				error = IOError('Wikidata API returned status %s' % urlobj.status)
+			time.sleep(2 ** attempt)
+		raise error
+
+class State(object):
+	"""The progress of a run, saved atomically to a JSON file."""
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		self.saved = 0
+		if os.path.exists(path):
+			with open(path) as f:
+				self.data = json.load(f)
+		else:
+			self.data = {}
+
+	def save(self):
+		with self.lock:
+			tmppath = self.path + '.tmp'
+			with open(tmppath, 'w') as f:
+				json.dump(self.data, f)
+			os.rename(tmppath, self.path)
+			self.saved = time.time()
+
+	def save_every(self, interval):
+		if time.time() - self.saved >= interval:
+			self.save()
+
+def list_titles(conn, state, param, listname):
+	"""Adds all titles of the list query param to state.
 
-def fetch_wikidata_props():
-	WIKIDATA_API_URL = 'https://www.wikidata.org/w/api.php'
+	The continue token is saved with every page, so listing resumes after
+	the last page saved.
+	"""
+	run = state.data['run']
+	while not run['listed']:
+		cur_param = dict(param)
+		cur_param.update(run['continue'] or {})
+		json_data = conn.query(cur_param)
+		for page in json_data['query'][listname]:
+			run['titles'][page['title']] = True
+		run['continue'] = json_data.get('continue')
+		run['listed'] = not run['continue']
+		state.save()
+
+def fetch_terms(conn, titles):
+	"""Returns a dict from property id to labels and aliases for titles.
+
+	Properties that no longer exist are mapped to None.
+	"""
 	param = {}
-	param['action'] = 'query'
-	param['format'] = 'json'
-	param['generator'] = 'allpages'
-	param['gapnamespace'] = 120
-	param['gaplimit'] = 'max'
 	param['prop'] = 'pageterms'
 	param['wbptterms'] = 'label|alias'
-	while True:
-		params = urllib.urlencode(param)
-		url = WIKIDATA_API_URL + '?' + params
-		urlobj = urllib2.urlopen(url)
-		json_data = json.load(urlobj)
-		for pageid, resp in json_data['query']['pages'].items():
-			labels = list(resp['terms']['label'])
-			if resp['terms'].get('alias'):
-				labels.extend(resp['terms']['alias'])
-			filename = resp['title'].replace('Property:', '')
-			filestream = open(filename, 'w')
-			content = '\n'.join(labels)
-			filestream.write(content.encode('utf-8'))
-			filestream.close()
-		if json_data.get('continue'):
-			param.update(json_data['continue'])
-		else:
-			break
-				
+	param['titles'] = '|'.join(titles).encode('utf-8')
+	json_data = conn.query(param)
+	props = {}
+	for pageid, resp in json_data['query']['pages'].items():
+		pid = resp['title'].replace('Property:', '')
+		if 'missing' in resp:
+			props[pid] = None
+			continue
+		terms = resp.get('terms', {})
+		labels = list(terms.get('label', []))
+		if terms.get('alias'):
+			labels.extend(terms['alias'])
+		props[pid] = labels
+	return props
+
+def fetch_all_terms(api_url, state, workers):
+	"""Fetches the terms of all listed titles not fetched yet, in batches
+	on several workers. Fetched terms are kept in state."""
+	run = state.data['run']
+	titles = sorted(title for title, pending in run['titles'].items() if pending)
+	batches = Queue.Queue()
+	for i in range(0, len(titles), BATCH_SIZE):
+		batches.put(titles[i:i + BATCH_SIZE])
+	errors = []
+
+	def worker():
+		conn = WikidataConnection(api_url)
+		while not errors:
+			try:
+				batch = batches.get_nowait()
+			except Queue.Empty:
+				return
+			try:
+				props = fetch_terms(conn, batch)
+			except Exception as e:
+				errors.append(e)
+				return
+			with state.lock:
+				run['properties'].update(props)
+				for title in batch:
+					run['titles'][title] = False
+			state.save_every(SAVE_INTERVAL)
+
+	threads = [threading.Thread(target = worker) for _ in range(workers)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	state.save()
+	if errors:
+		raise errors[0]
+
+def property_number(pid):
+	return int(pid.lstrip('P'))
+
+def write_text_files(props, path):
+	for pid, labels in props.items():
+		if labels is None:
+			continue
+		filestream = open(os.path.join(path, pid + '.txt'), 'w')
+		content = '\n'.join(labels)
+		filestream.write(content.encode('utf-8'))
+		filestream.close()
+
+def fetch_wikidata_props(api_url = WIKIDATA_API_URL, bundle_path = BUNDLE_PATH, state_path = None,
+		workers = 8, incremental = False, text_dir = None):
+	state = State(state_path or bundle_path + '.state')
+	now = datetime.datetime.utcnow()
+	if 'run' not in state.data:
+		last_run = state.data.get('last_run')
+		if incremental and not (last_run and os.path.exists(bundle_path)):
+			print 'No completed run to continue from, fetching all properties.'
+			incremental = False
+		if incremental and now - datetime.datetime.strptime(last_run, TIMESTAMP_FORMAT) > MAX_INCREMENTAL_AGE:
+			print 'Last run is too old for recent changes, fetching all properties.'
+			incremental = False
+		state.data['run'] = {'started': now.strftime(TIMESTAMP_FORMAT), 'incremental': incremental,
+			'since': last_run, 'listed': False, 'continue': None, 'titles': {}, 'properties': {}}
+		state.save()
+	else:
+		print 'Resuming interrupted run.'
+	run = state.data['run']
+	conn = WikidataConnection(api_url)
+	if run['incremental']:
+		param = {}
+		param['list'] = 'recentchanges'
+		param['rcnamespace'] = PROPERTY_NAMESPACE
+		param['rctype'] = 'edit|new'
+		param['rcprop'] = 'title'
+		param['rcdir'] = 'newer'
+		param['rcstart'] = run['since']
+		param['rclimit'] = 'max'
+		list_titles(conn, state, param, 'recentchanges')
+	else:
+		param = {}
+		param['list'] = 'allpages'
+		param['apnamespace'] = PROPERTY_NAMESPACE
+		param['aplimit'] = 'max'
+		list_titles(conn, state, param, 'allpages')
+	print 'Listed %s properties, fetching their terms.' % len(run['titles'])
+	fetch_all_terms(api_url, state, workers)
+	props = {}
+	if run['incremental']:
+		props.update(PropertyBundle(bundle_path))
+	props.update(run['properties'])
+	props = dict((pid, labels) for pid, labels in props.items() if labels is not None)
+	write_bundle(sorted(props.items(), key = lambda item: property_number(item[0])), bundle_path, tokenize)
+	if text_dir:
+		write_text_files(run['properties'], text_dir)
+	print 'Wrote %s properties (%s fetched) to %s.' % (len(props), len(run['properties']), bundle_path)
+	state.data = {'last_run': run['started']}
+	state.save()
+
 if __name__ == '__main__':
-	fetch_wikidata_props()
\ No newline at end of file
+	parser = argparse.ArgumentParser(description = __doc__)
+	parser.add_argument('--api-url', default = WIKIDATA_API_URL)
+	parser.add_argument('--bundle', default = BUNDLE_PATH, help = 'property bundle to write')
+	parser.add_argument('--state', help = 'state file, defaults to the bundle path + .state')
+	parser.add_argument('--workers', type = int, default = 8)
+	parser.add_argument('--incremental', action = 'store_true',
+		help = 'only fetch properties changed since the last completed run')
+	parser.add_argument('--text-dir', help = 'also write one text file per fetched property to this directory')
+	args = parser.parse_args()
+	fetch_wikidata_props(args.api_url, args.bundle, args.state, args.workers, args.incremental, args.text_dir)
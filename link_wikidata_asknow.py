@@ -1,20 +1,88 @@
 # coding=utf-8
+"""Writes the mapping of DBpedia properties to Wikidata properties.
+
+The equivalent properties are read from the DBpedia SPARQL endpoint page
+by page, each page is parsed line by line as it arrives, and the pairs of
+a page are written to a tab-separated file once the page is complete, so
+at most one page is held in memory. The file is loaded by
+asknow-UI/propertymap.py.
+"""
+import httplib
+import os
+import re
+import sys
+import time
 import urllib, urllib2
-import json
 
-def link_wikidata_asknow():
-	DBPEDIA_API_URL = 'http://dbpedia.org/sparql'
+DBPEDIA_API_URL = 'http://dbpedia.org/sparql'
+MAPPING_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'asknow-UI', 'data', 'property_mapping.tsv')
+PAGE_SIZE = 10000 # the endpoint returns at most 10000 rows per query
+RETRIES = 3
+PID_RE = re.compile(r'/(P\d+)$')
+
+class PartialResult(IOError):
+	"""The endpoint ran out of time and returned only part of a page."""
+
+def fetch_page(offset, limit = PAGE_SIZE):
+	"""Yields the (DBpedia property, Wikidata property) URI pairs of one page.
+
+	Virtuoso answers a query that hits its timeout with the rows found so
+	far and an X-SQL-State header, that page raises PartialResult.
+	"""
 	param = {}
-	param['query'] = 'select ?url ?prop where { ?url owl:equivalentProperty ?prop FILTER(regex(?prop, "^http://www.wikidata.org")) }'
+	param['query'] = ('select ?url ?prop where { ?url owl:equivalentProperty ?prop '
+		'FILTER(regex(?prop, "^http://www.wikidata.org")) } '
+		'order by ?url ?prop limit %s offset %s' % (limit, offset))
 	param['default-graph-uri'] = 'http://dbpedia.org'
-	param['format'] = 'application/sparql-results+json'
+	param['format'] = 'text/tab-separated-values'
 	param['timeout'] = 30000
 	params = urllib.urlencode(param)
 	url = DBPEDIA_API_URL + '?' + params
-	urlobj = urllib2.urlopen(url)
-	json_data = json.load(urlobj)
-	for prop in json_data['results']['bindings']:
-		print '"%s", "%s"' % (prop['url']['value'], prop['prop']['value'])
-				
+	urlobj = urllib2.urlopen(url, timeout = 60)
+	try:
+		state = urlobj.info().getheader('X-SQL-State')
+		if state:
+			raise PartialResult('%s %s' % (state, urlobj.info().getheader('X-SQL-Message', '')))
+		urlobj.readline() # header
+		for line in urlobj:
+			fields = line.rstrip('\r\n').split('\t')
+			if len(fields) != 2:
+				continue
+			yield [field.strip('"<>') for field in fields]
+	finally:
+		urlobj.close()
+
+def link_wikidata_asknow(path = MAPPING_PATH):
+	tmppath = path + '.tmp'
+	count = 0
+	with open(tmppath, 'w') as out:
+		offset = 0
+		while True:
+			for attempt in range(RETRIES):
+				rows = 0
+				lines = []
+				try:
+					for dbpurl, prop in fetch_page(offset):
+						rows += 1
+						match = PID_RE.search(prop)
+						if match:
+							lines.append('%s\t%s\n' % (dbpurl, match.group(1)))
+				except (urllib2.URLError, IOError, httplib.HTTPException) as e:
+					print 'Cannot fetch rows from offset %s: %s' % (offset, e)
+					time.sleep(2 ** attempt)
+				else:
+					break
+			else:
+				sys.exit('Giving up at offset %s.' % offset)
+			# A page is only written once it is complete, so a retry does not
+			# duplicate rows. At most one page is held in memory.
+			out.writelines(lines)
+			count += len(lines)
+			print '%s properties linked.' % count
+			if rows < PAGE_SIZE:
+				break
+			offset += PAGE_SIZE
+	os.rename(tmppath, path)
+
 if __name__ == '__main__':
-	link_wikidata_asknow()
\ No newline at end of file
+	link_wikidata_asknow(*sys.argv[1:2])
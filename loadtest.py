@@ -0,0 +1,339 @@
+# coding=utf-8
+"""Load tests the AskNow demonstrator against local stand-in upstreams.
+
+Stand-in Genesis, DBpedia Spotlight and AskNow servers are started on
+localhost with configurable latency, error rate and payload size, and the
+demonstrator is pointed at them through GENESIS_API_URL, DBPEDIASL_URL and
+ASKNOW_URL. /asknow/json and /asknow/demo are then requested through the
+WSGI app of asknow.py by concurrent workers, with the App Engine SDK stubs
+for memcache, urlfetch and the datastore, so no network is needed. The
+App Engine SDK for Python must be installed, see --sdk; a plain Python 2.7
+is not enough.
+
+Throughput and p50/p95/p99 latency of the successful requests and the
+number of failed ones are reported per scenario. A run can
+be saved as a baseline, and later runs compared with it:
+  python loadtest.py --save-baseline loadtest-baseline.json
+  python loadtest.py --baseline loadtest-baseline.json
+A run fails if its p95 latency or throughput is worse than the baseline by
+more than --tolerance.
+
+The SDK stubs complete asynchronous urlfetch calls one at a time, so the
+Genesis latencies of a request add up here, unless the fetches are made
+with --fetch threads as outside App Engine, see asknow-UI/backends.py.
+Compare runs with each other, not with production.
+"""
+import argparse
+import BaseHTTPServer
+import json
+import logging
+import os
+import random
+import SocketServer
+import sys
+import threading
+import time
+import urllib
+import urlparse
+from appengine_sdk import use_sdk
+
+UI_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'asknow-UI')
+SCENARIOS = ['json', 'json-cold', 'demo', 'demo-cold', 'demo-user']
+SERVICES = ['genesis', 'spotlight', 'asknow']
+
+class Behaviour(object):
+	"""How a stand-in server answers: latency, jitter and error rate."""
+	def __init__(self, latency, jitter, error_rate):
+		self.latency = latency
+		self.jitter = jitter
+		self.error_rate = error_rate
+
+	def delay(self):
+		time.sleep(self.latency + random.uniform(0, self.jitter))
+
+	def fails(self):
+		return random.random() < self.error_rate
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def do_GET(self):
+		self.answer()
+
+	def do_POST(self):
+		self.answer()
+
+	def answer(self):
+		length = int(self.headers.get('Content-Length') or 0)
+		body = self.rfile.read(length) if length else ''
+		behaviour = self.server.behaviour
+		behaviour.delay()
+		if behaviour.fails():
+			self.send(503, {'error': 'stand-in failure'})
+			return
+		self.send(200, self.server.payload(self.path, body))
+
+	def send(self, status, data):
+		content = json.dumps(data)
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(content)))
+		self.end_headers()
+		self.wfile.write(content)
+
+	def log_message(self, format, *args):
+		pass
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	"""A local HTTP server answering with payload(path, body)."""
+	daemon_threads = True
+
+	def __init__(self, behaviour, payload):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+		self.behaviour = behaviour
+		self.payload = payload
+		self.thread = threading.Thread(target = self.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def url(self, path):
+		return 'http://127.0.0.1:%s%s' % (self.server_address[1], path)
+
+def entity(name, i):
+	return {'url': 'http://dbpedia.org/resource/%s_%s' % (name, i), 'title': '%s %s' % (name, i),
+		'image': 'http://127.0.0.1/images/%s_%s.png' % (name, i)}
+
+def genesis_payload(items):
+	def payload(path, body):
+		api = path.rstrip('/').rsplit('/', 1)[-1]
+		request = json.loads(body or '{}')
+		name = request.get('q') or request.get('url', '').rsplit('/', 1)[-1]
+		if api == 'description':
+			return {'description': {'description': ('%s is an entity. ' % name) * items,
+				'image': 'http://127.0.0.1/images/%s.png' % name}}
+		elif api == 'images':
+			return {'images': ['http://127.0.0.1/images/%s_%s.png' % (name, i) for i in range(items)]}
+		elif api == 'videos':
+			return {'videos': [{'url': 'watch?v=%s' % i, 'image': 'http://127.0.0.1/videos/%s.png' % i,
+				'title': '%s %s' % (name, i), 'duration': '3:00'} for i in range(items)]}
+		elif api == 'similar':
+			return {'similarEntities': [entity('Similar', i) for i in range(items)]}
+		return {'relatedEntities': [entity('Related', i) for i in range(items)]}
+	return payload
+
+def spotlight_payload(entities):
+	# One entity per long word of the text, so every question has some.
+	def payload(path, body):
+		text = urlparse.parse_qs(urlparse.urlsplit(path).query).get('text', [''])[0]
+		words = [w for w in text.split() if len(w) > 5][:entities]
+		return {'Resources': [{'@URI': 'http://dbpedia.org/resource/' + w.capitalize()} for w in words]}
+	return payload
+
+def asknow_payload(path, body):
+	q = urlparse.parse_qs(urlparse.urlsplit(path).query).get('q', [''])[0]
+	return {'question': q, 'answers': ['Stand-in'], 'answered': True, 'lenanswers': 1,
+		'status': 0, 'message': 'Connection successful.', 'information': []}
+
+def start_stand_ins(args):
+	def behaviour(service):
+		latency = getattr(args, service + '_latency')
+		error_rate = getattr(args, service + '_error_rate')
+		return Behaviour((args.latency if latency is None else latency) / 1000.0, args.jitter / 1000.0,
+			args.error_rate if error_rate is None else error_rate)
+	servers = {}
+	servers['genesis'] = StandInServer(behaviour('genesis'), genesis_payload(args.items))
+	servers['spotlight'] = StandInServer(behaviour('spotlight'), spotlight_payload(args.entities))
+	servers['asknow'] = StandInServer(behaviour('asknow'), asknow_payload)
+	os.environ['GENESIS_API_URL'] = servers['genesis'].url('/api/')
+	os.environ['DBPEDIASL_URL'] = servers['spotlight'].url('/en/annotate')
+	os.environ['ASKNOW_URL'] = servers['asknow'].url('/asknow/json')
+	return servers
+
+def load_questions():
+	with open(os.path.join(UI_PATH, 'data', 'answers.jsonl')) as f:
+		questions = [json.loads(line)['question'] for line in f if line.strip()]
+	# Questions AskNow cannot answer, whose entities come from Spotlight.
+	questions.extend(['where was angela merkel born', 'what is the population of frankfurt',
+		'who developed the theory of relativity'])
+	return questions
+
+def percentile(timings, p):
+	# Nearest rank of sorted timings in ms, None without timings.
+	if not timings:
+		return None
+	rank = max(1, int(round(p / 100.0 * len(timings))))
+	return timings[min(rank, len(timings)) - 1] * 1000
+
+def format_ms(ms):
+	return '%9.1f' % ms if ms is not None else '%9s' % '-'
+
+class LoadTest(object):
+	"""Requests a scenario from the WSGI app with concurrent workers."""
+	def __init__(self, app, questions, concurrency, requests, warmup):
+		self.app = app
+		self.questions = questions
+		self.concurrency = concurrency
+		self.requests = requests
+		self.warmup = warmup
+		self.counter = 0
+		self.lock = threading.Lock()
+
+	def next_number(self):
+		with self.lock:
+			self.counter = self.counter + 1
+			return self.counter
+
+	def make_request(self, scenario):
+		import webapp2
+		from handlerlib import Handler
+		n = self.next_number()
+		q = self.questions[n % len(self.questions)]
+		if scenario.endswith('-cold'):
+			# A word Spotlight turns into an entity, so nothing is cached.
+			q = '%s loadtest%s' % (q, n)
+		path = '/asknow/json' if scenario.startswith('json') else '/asknow/demo'
+		request = webapp2.Request.blank(path + '?' + urllib.urlencode({'q': q}))
+		if scenario == 'demo-user':
+			handler = Handler(request, webapp2.Response())
+			request.headers['Cookie'] = '%s=%s' % (Handler.SESSION_COOKIE,
+				handler.make_session_token(1 + n % 10, u'loadtest%s' % (n % 10)))
+		return request
+
+	def run(self, scenario):
+		timings = []
+		errors = [0]
+		pending = [self.warmup + self.requests]
+
+		def worker():
+			while True:
+				with self.lock:
+					if pending[0] <= 0:
+						return
+					pending[0] = pending[0] - 1
+					measured = pending[0] < self.requests
+				request = self.make_request(scenario)
+				start = time.time()
+				try:
+					response = request.get_response(self.app)
+					response.body
+					failed = response.status_int >= 500
+				except Exception:
+					logging.exception('Request for %s failed' % request.path_qs)
+					failed = True
+				elapsed = time.time() - start
+				if measured:
+					with self.lock:
+						if failed:
+							errors[0] = errors[0] + 1
+						else:
+							timings.append(elapsed)
+
+		start = time.time()
+		threads = [threading.Thread(target = worker) for _ in range(self.concurrency)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		duration = time.time() - start
+		timings.sort()
+		return {
+			'requests': len(timings) + errors[0],
+			'errors': errors[0],
+			'throughput': len(timings) / duration if duration else 0.0,
+			'p50': percentile(timings, 50),
+			'p95': percentile(timings, 95),
+			'p99': percentile(timings, 99),
+		}
+
+def setup_sdk(sdk = None):
+	use_sdk(sdk)
+	from google.appengine.ext import testbed
+	bed = testbed.Testbed()
+	bed.activate()
+	bed.init_datastore_v3_stub()
+	bed.init_memcache_stub()
+	bed.init_urlfetch_stub()
+	return bed
+
+def compare(results, baseline, tolerance):
+	"""Returns the regressions of results against baseline."""
+	regressions = []
+	for scenario, result in sorted(results.items()):
+		base = baseline.get('results', {}).get(scenario)
+		if not base:
+			continue
+		if result['p95'] is None and base['p95'] is not None:
+			regressions.append('%s: no successful requests' % scenario)
+		elif result['p95'] is not None and base['p95'] is not None and result['p95'] > base['p95'] * (1 + tolerance):
+			regressions.append('%s: p95 %.1fms, baseline %.1fms' % (scenario, result['p95'], base['p95']))
+		if result['throughput'] < base['throughput'] * (1 - tolerance):
+			regressions.append('%s: throughput %.1f/s, baseline %.1f/s' % (scenario, result['throughput'], base['throughput']))
+		if result['errors'] > base['errors']:
+			regressions.append('%s: %s errors, baseline %s' % (scenario, result['errors'], base['errors']))
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--sdk', help = 'App Engine SDK directory, defaults to $APPENGINE_SDK or the one on the PATH')
+	parser.add_argument('--scenario', action = 'append', choices = SCENARIOS,
+		help = 'scenario to run, can be repeated, defaults to all')
+	parser.add_argument('--concurrency', type = int, default = 8)
+	parser.add_argument('--requests', type = int, default = 200, help = 'measured requests per scenario')
+	parser.add_argument('--warmup', type = int, default = 20, help = 'requests per scenario before measuring')
+	parser.add_argument('--latency', type = float, default = 50, help = 'stand-in latency in ms')
+	parser.add_argument('--jitter', type = float, default = 20, help = 'random extra stand-in latency in ms')
+	parser.add_argument('--error-rate', type = float, default = 0.0, help = 'share of stand-in requests failing with 503')
+	for service in SERVICES:
+		parser.add_argument('--%s-latency' % service, type = float, help = 'overrides --latency for %s' % service)
+		parser.add_argument('--%s-error-rate' % service, type = float, help = 'overrides --error-rate for %s' % service)
+	parser.add_argument('--items', type = int, default = 10, help = 'list items per Genesis response')
+	parser.add_argument('--entities', type = int, default = 2, help = 'maximum entities per Spotlight response')
+	parser.add_argument('--cache', choices = ['appengine', 'memory'], default = 'appengine',
+		help = 'cache backend, appengine is the memcache stub')
+	parser.add_argument('--fetch', choices = ['appengine', 'threads'], default = 'appengine',
+		help = 'fetch backend, appengine is the urlfetch stub')
+	parser.add_argument('--baseline', help = 'baseline file to compare with')
+	parser.add_argument('--save-baseline', help = 'file to save the results to as a baseline')
+	parser.add_argument('--tolerance', type = float, default = 0.2, help = 'allowed relative regression')
+	args = parser.parse_args()
+
+	bed = setup_sdk(args.sdk)
+	logging.getLogger().setLevel(logging.WARNING)
+	servers = start_stand_ins(args)
+	os.environ['ASKNOW_CACHE'] = args.cache
+	os.environ['ASKNOW_FETCH'] = args.fetch
+	sys.path.insert(0, UI_PATH)
+	from asknow import app
+	test = LoadTest(app, load_questions(), args.concurrency, args.requests, args.warmup)
+	results = {}
+	print '%-12s %8s %7s %10s %9s %9s %9s' % ('scenario', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms')
+	for scenario in args.scenario or SCENARIOS:
+		result = test.run(scenario)
+		results[scenario] = result
+		print '%-12s %8d %7d %10.1f %s %s %s' % (scenario, result['requests'], result['errors'],
+			result['throughput'], format_ms(result['p50']), format_ms(result['p95']), format_ms(result['p99']))
+		if result['requests'] and result['errors'] == result['requests']:
+			print 'All %s requests of %s failed, see the log.' % (result['requests'], scenario)
+	for server in servers.values():
+		server.shutdown()
+	bed.deactivate()
+	settings = dict((key, value) for key, value in vars(args).items()
+		if key not in ('sdk', 'baseline', 'save_baseline', 'scenario'))
+	if args.save_baseline:
+		with open(args.save_baseline, 'w') as f:
+			json.dump({'settings': settings, 'results': results}, f, indent = 2, sort_keys = True)
+		print 'Baseline saved to %s.' % args.save_baseline
+	if args.baseline:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		if baseline.get('settings') != settings:
+			print 'Warning: the baseline was run with other settings.'
+		regressions = compare(results, baseline, args.tolerance)
+		for regression in regressions:
+			print 'Regression in %s' % regression
+		if regressions:
+			sys.exit(1)
+		print 'No regressions against %s.' % args.baseline
+
+if __name__ == '__main__':
+	main()
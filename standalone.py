@@ -0,0 +1,197 @@
+# coding=utf-8
+"""Runs the AskNow demonstrator outside App Engine, on a WSGI server with a
+pool of threads in each of one or more processes:
+  python standalone.py --port 8080 --threads 16 --processes 4 \\
+      --cache memcached --storage cloud
+
+The cache, fetch and storage backends are described in
+asknow-UI/backends.py; here they default to memory, threads and local.
+Only memcached and Cloud Datastore (or its emulator) are shared by several
+processes, the local datastore file is for one process. ndb is still taken
+from the App Engine SDK, see --sdk.
+
+Like app.yaml, the server serves /css and /images as static files and only
+lets requests to /asknow/stats and /asknow/tasks/ in from this host. There
+is no cron here, so the warm up of cron.yaml is left to the cron of the
+host, e.g. curl -s http://localhost:8080/asknow/tasks/warmup
+
+Other WSGI servers can serve standalone:app instead, with the backends set
+by the environment variables of backends.py, e.g.
+  gunicorn --workers 4 --threads 8 standalone:app
+"""
+import argparse
+import logging
+import mimetypes
+import os
+import posixpath
+import Queue
+import signal
+import sys
+import threading
+from wsgiref import simple_server
+from appengine_sdk import use_sdk
+
+UI_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'asknow-UI')
+STATIC_PATHS = {'/css/': os.path.join(UI_PATH, 'css'), '/images/': os.path.join(UI_PATH, 'images')}
+STATIC_MAX_AGE = 600 # the default expiration of static files on App Engine
+ADMIN_PATHS = ('/asknow/stats', '/asknow/tasks/')
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+BACKEND_DEFAULTS = {'ASKNOW_CACHE': 'memory', 'ASKNOW_FETCH': 'threads', 'ASKNOW_STORAGE': 'local'}
+
+class StaticFiles(object):
+	"""Serves the static directories of app.yaml, other requests go to app."""
+	def __init__(self, app, paths = STATIC_PATHS):
+		self.app = app
+		self.paths = paths
+
+	def __call__(self, environ, start_response):
+		path = environ.get('PATH_INFO', '')
+		for prefix, directory in self.paths.items():
+			if path.startswith(prefix):
+				return self.serve(directory, path[len(prefix):], start_response)
+		return self.app(environ, start_response)
+
+	def serve(self, directory, name, start_response):
+		name = posixpath.normpath('/' + name).lstrip('/')
+		filename = os.path.join(directory, *name.split('/'))
+		if not name or not os.path.isfile(filename):
+			start_response('404 Not Found', [('Content-Type', 'text/plain')])
+			return ['Not found']
+		with open(filename, 'rb') as f:
+			body = f.read()
+		start_response('200 OK', [
+			('Content-Type', mimetypes.guess_type(filename)[0] or 'application/octet-stream'),
+			('Content-Length', str(len(body))),
+			('Cache-Control', 'public, max-age=%s' % STATIC_MAX_AGE)])
+		return [body]
+
+class LocalAdmin(object):
+	"""Forbids the admin paths of app.yaml to other hosts. Behind a proxy on
+	this host, block them in the proxy."""
+	def __init__(self, app):
+		self.app = app
+
+	def __call__(self, environ, start_response):
+		if environ.get('PATH_INFO', '').startswith(ADMIN_PATHS) and environ.get('REMOTE_ADDR') not in LOCAL_ADDRESSES:
+			start_response('403 Forbidden', [('Content-Type', 'text/plain')])
+			return ['Forbidden']
+		return self.app(environ, start_response)
+
+def make_app(sdk = None):
+	"""Returns the WSGI app of asknow.py on the backends of the environment."""
+	for name, value in BACKEND_DEFAULTS.items():
+		os.environ.setdefault(name, value)
+	use_sdk(sdk)
+	sys.path.insert(0, UI_PATH)
+	import asknow
+	return StaticFiles(LocalAdmin(asknow.app))
+
+class RequestHandler(simple_server.WSGIRequestHandler):
+	def log_message(self, format, *args):
+		logging.info('%s %s' % (self.client_address[0], format % args))
+
+class ThreadPoolServer(simple_server.WSGIServer):
+	"""Handles the connections on a pool of threads.
+
+	The threads are started by serve_forever, so the server can be forked
+	before. While all threads are busy, new connections wait in the listen
+	backlog.
+	"""
+	request_queue_size = 128
+
+	def __init__(self, address, app, threads):
+		simple_server.WSGIServer.__init__(self, address, RequestHandler)
+		self.set_app(app)
+		self.threads = threads
+		self.connections = Queue.Queue(threads)
+
+	def serve_forever(self, poll_interval = 0.5):
+		for i in range(self.threads):
+			thread = threading.Thread(target = self.work)
+			thread.daemon = True
+			thread.start()
+		simple_server.WSGIServer.serve_forever(self, poll_interval)
+
+	def process_request(self, request, client_address):
+		self.connections.put((request, client_address))
+
+	def work(self):
+		while True:
+			request, client_address = self.connections.get()
+			try:
+				self.finish_request(request, client_address)
+			except Exception:
+				self.handle_error(request, client_address)
+			finally:
+				self.shutdown_request(request)
+
+def serve(server, processes):
+	"""Serves in processes forked from this one, which share the socket of
+	server. Returns when they all stopped."""
+	if processes == 1:
+		server.serve_forever()
+		return
+	# The processes race for every connection, the losers must not block.
+	server.socket.setblocking(0)
+	children = []
+	for i in range(processes):
+		pid = os.fork()
+		if pid == 0:
+			try:
+				server.serve_forever()
+			finally:
+				os._exit(1)
+		children.append(pid)
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	try:
+		for pid in children:
+			os.waitpid(pid, 0)
+	finally:
+		for pid in children:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except OSError:
+				pass
+
+def main():
+	parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--host', default = 'localhost', help = 'address to listen on, e.g. 0.0.0.0 for all')
+	parser.add_argument('--port', type = int, default = 8080)
+	parser.add_argument('--threads', type = int, default = 16, help = 'threads per process')
+	parser.add_argument('--processes', type = int, default = 1)
+	parser.add_argument('--sdk', help = 'App Engine SDK directory, defaults to $APPENGINE_SDK or the one on the PATH')
+	parser.add_argument('--cache', choices = ['memory', 'memcached'],
+		default = os.environ.get('ASKNOW_CACHE', BACKEND_DEFAULTS['ASKNOW_CACHE']))
+	parser.add_argument('--memcached', help = 'comma separated memcached servers, defaults to $MEMCACHED_SERVERS or 127.0.0.1:11211')
+	parser.add_argument('--storage', choices = ['local', 'cloud'],
+		default = os.environ.get('ASKNOW_STORAGE', BACKEND_DEFAULTS['ASKNOW_STORAGE']))
+	parser.add_argument('--datastore-path', help = 'file of the local storage, defaults to $ASKNOW_DATASTORE_PATH or asknow-UI/data/datastore.sqlite')
+	parser.add_argument('--project', help = 'Cloud Datastore project, defaults to $DATASTORE_PROJECT_ID')
+	parser.add_argument('--log-level', default = 'WARNING', choices = ['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+	args = parser.parse_args()
+	if args.processes > 1 and args.storage == 'local':
+		parser.error('the local storage is for one process, use --storage cloud with --processes')
+	logging.getLogger().setLevel(getattr(logging, args.log_level))
+	if args.processes > 1 and args.cache == 'memory':
+		logging.warning('Every process has a cache of its own, use --cache memcached to share it.')
+
+	os.environ['ASKNOW_CACHE'] = args.cache
+	os.environ['ASKNOW_FETCH'] = 'threads'
+	os.environ['ASKNOW_STORAGE'] = args.storage
+	for name, value in (('MEMCACHED_SERVERS', args.memcached), ('ASKNOW_DATASTORE_PATH', args.datastore_path),
+			('DATASTORE_PROJECT_ID', args.project)):
+		if value:
+			os.environ[name] = value
+	app = make_app(args.sdk)
+	server = ThreadPoolServer((args.host, args.port), app, args.threads)
+	print 'Serving http://%s:%s/asknow/demo with %s processes of %s threads.' % (args.host, args.port,
+		args.processes, args.threads)
+	try:
+		serve(server, args.processes)
+	except KeyboardInterrupt:
+		pass
+
+if __name__ == '__main__':
+	main()
+else:
+	app = make_app()
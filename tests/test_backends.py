@@ -0,0 +1,87 @@
+# coding=utf-8
+"""Tests of the deadline of ThreadFetch in backends.py, against a local
+server that sends its response slowly.
+
+Run with python -m unittest discover tests, no App Engine SDK is needed.
+"""
+import BaseHTTPServer
+import os
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import unittest
+
+os.environ.setdefault('ASKNOW_CACHE', 'memory')
+os.environ.setdefault('ASKNOW_FETCH', 'threads')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'asknow-UI'))
+import backends
+
+class TrickleHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	# /fast answers at once, /slow sends a byte every 0.05s for a second.
+	def do_GET(self):
+		slow = self.path == '/slow'
+		body = 'x' * 20
+		self.send_response(200)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		for byte in body:
+			self.wfile.write(byte)
+			self.wfile.flush()
+			if slow and self.server.stopped.wait(0.05):
+				return
+
+	def log_message(self, format, *args):
+		pass
+
+class TrickleServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	stopped = threading.Event()
+
+	def handle_error(self, request, client_address):
+		pass # the client hung up on a slow response
+
+class ThreadFetchTest(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.server = TrickleServer(('127.0.0.1', 0), TrickleHandler)
+		thread = threading.Thread(target = cls.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+		cls.url = 'http://127.0.0.1:%s' % cls.server.server_address[1]
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.server.stopped.set()
+		cls.server.shutdown()
+		cls.server.server_close()
+
+	def setUp(self):
+		self.fetch = backends.ThreadFetch(max_threads = 4)
+
+	def test_fetch(self):
+		response = self.fetch.fetch(self.url + '/fast', deadline = 1)
+		self.assertEqual((response.status_code, response.content), (200, 'x' * 20))
+
+	def test_fetch_deadline(self):
+		start = time.time()
+		self.assertRaises(socket.timeout, self.fetch.fetch, self.url + '/slow', deadline = 0.3)
+		self.assertLess(time.time() - start, 0.6)
+
+	def test_rpc_deadline(self):
+		rpc = self.fetch.create_rpc(deadline = 0.3)
+		start = time.time()
+		self.fetch.make_fetch_call(rpc, self.url + '/slow')
+		self.assertIs(self.fetch.wait_any([rpc]), rpc)
+		self.assertRaises(socket.timeout, rpc.get_result)
+		self.assertLess(time.time() - start, 0.6)
+
+	def test_rpc(self):
+		rpcs = [self.fetch.create_rpc(deadline = 1) for i in range(3)]
+		for rpc in rpcs:
+			self.fetch.make_fetch_call(rpc, self.url + '/fast')
+		self.assertEqual([rpc.get_result().content for rpc in rpcs], ['x' * 20] * 3)
+
+if __name__ == '__main__':
+	unittest.main()
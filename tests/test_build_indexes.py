@@ -0,0 +1,88 @@
+# coding=utf-8
+"""A smoke test of build_indexes.py: builds a tiny property bundle and
+gazetteer in a pool of two workers and links with them.
+
+Run with python -m unittest discover tests, no App Engine SDK is needed.
+"""
+import gzip
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import build_indexes
+from entitylinker import Gazetteer
+from relationlinker import RelationIndex
+
+WORKERS = 2
+PROPERTIES = {
+	'P19': [u'place of birth', u'birthplace', u'born in'],
+	'P26': [u'spouse', u'wife', u'husband'],
+	'P1082': [u'population', u'number of inhabitants'],
+}
+LABELS = '''# started 2016-10-20
+<http://dbpedia.org/resource/Barack_Obama> <http://www.w3.org/2000/01/rdf-schema#label> "Barack Obama"@en .
+<http://dbpedia.org/resource/Berlin> <http://www.w3.org/2000/01/rdf-schema#label> "Berlin"@en .
+<http://dbpedia.org/resource/Z%C3%BCrich> <http://www.w3.org/2000/01/rdf-schema#label> "Z\\u00FCrich"@en .
+<http://dbpedia.org/resource/Mercury_(planet)> <http://www.w3.org/2000/01/rdf-schema#label> "Mercury (planet)"@en .
+<http://dbpedia.org/resource/Berlin_(disambiguation)> <http://www.w3.org/2000/01/rdf-schema#label> "Berlin"@en .
+'''
+DISAMBIGUATIONS = '''<http://dbpedia.org/resource/Berlin_(disambiguation)> <http://dbpedia.org/ontology/wikiPageDisambiguates> <http://dbpedia.org/resource/Berlin> .
+'''
+
+class BuildIndexesTest(unittest.TestCase):
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+	def write_gzip(self, name, data):
+		path = os.path.join(self.path, name)
+		f = gzip.open(path, 'wb')
+		try:
+			f.write(data)
+		finally:
+			f.close()
+		return path
+
+	def test_relations(self):
+		properties = os.path.join(self.path, 'properties')
+		os.mkdir(properties)
+		for pid, labels in PROPERTIES.items():
+			with open(os.path.join(properties, pid + '.txt'), 'w') as f:
+				f.write('\n'.join(labels).encode('utf-8') + '\n')
+		bundle = os.path.join(self.path, 'properties.bundle')
+		pool = multiprocessing.Pool(WORKERS)
+		try:
+			self.assertEqual(build_indexes.build_relations(pool, WORKERS, properties, bundle), len(PROPERTIES))
+		finally:
+			pool.close()
+			pool.join()
+		index = RelationIndex.from_bundle(bundle)
+		self.assertEqual(len(index), len(PROPERTIES))
+		self.assertEqual(index.link('wife')[0][::2], ('P26', 'bm25'))
+		self.assertEqual(index.link('place of birth')[0][::2], ('P19', 'bm25'))
+		self.assertEqual(index.link('huband')[0][::2], ('P26', 'fuzzy'))
+		self.assertEqual(index.label('P1082'), u'population')
+		memory = RelationIndex.from_properties(sorted(PROPERTIES.items()))
+		for phrase in ('born in', 'husband', 'inhabitants'):
+			self.assertEqual(index.search(phrase), memory.search(phrase))
+
+	def test_entities(self):
+		labels = self.write_gzip('labels_en.ttl.gz', LABELS)
+		disambiguations = self.write_gzip('disambiguations_en.ttl.gz', DISAMBIGUATIONS)
+		gazetteer_path = os.path.join(self.path, 'gazetteer.marshal')
+		count = build_indexes.build_entities(WORKERS, labels, gazetteer_path, disambiguations)
+		self.assertEqual(count, 3)
+		gazetteer = Gazetteer.load(gazetteer_path)
+		self.assertEqual(gazetteer.link('is barack obama from berlin'), ([u'Barack Obama', u'Berlin'], 1.0))
+		self.assertEqual(gazetteer.link(u'zürich')[0], [u'Zürich'])
+		self.assertEqual(gazetteer.link('mercury planet'), ([], 0.0))
+
+if __name__ == '__main__':
+	unittest.main()
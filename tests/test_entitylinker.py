@@ -0,0 +1,64 @@
+# coding=utf-8
+"""Tests of the gazetteer of entitylinker.py.
+
+Run with python -m unittest discover tests, no App Engine SDK is needed.
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'asknow-UI'))
+import entitylinker
+
+LABELS = [(u'Barack Obama', u'Barack Obama'), (u'Obama', u'Barack Obama'), (u'Berlin', u'Berlin'),
+	(u'Population', u'Population'), (u'Mercury', u'Mercury (planet)'), (u'Mercury', u'Mercury (element)')]
+
+class GazetteerTest(unittest.TestCase):
+	def setUp(self):
+		# Make "population" a common word, as it is in the labels of DBpedia.
+		common = [(u'Population %s' % i, u'Population %s' % i) for i in range(entitylinker.COMMON_LABELS)]
+		self.gazetteer = entitylinker.Gazetteer.build(LABELS + common)
+
+	def test_longest_label(self):
+		titles, confidence = self.gazetteer.link('who is the wife of barack obama')
+		self.assertEqual(titles, [u'Barack Obama'])
+		self.assertAlmostEqual(confidence, 2.0 / 3)
+
+	def test_specific_label(self):
+		self.assertEqual(self.gazetteer.link('berlin'), ([u'Berlin'], 1.0))
+
+	def test_common_label(self):
+		self.assertEqual(self.gazetteer.link('population of berlin'), ([u'Berlin'], 0.5))
+		# Half of the question is not linked, so Spotlight links it.
+		self.assertIsNone(self.gazetteer.link_confidently('population of berlin', 0.5))
+		self.assertEqual(self.gazetteer.link('population of barack obama'), ([u'Barack Obama'], 2.0 / 3))
+		self.assertEqual(self.gazetteer.link_confidently('population of barack obama', 0.5), [u'Barack Obama'])
+
+	def test_link_confidently(self):
+		self.assertEqual(self.gazetteer.link_confidently('berlin', 0.5), [u'Berlin'])
+		self.assertIsNone(self.gazetteer.link_confidently('population', 0.5))
+		self.assertIsNone(self.gazetteer.link_confidently('how far is mercury', 0.5))
+
+	def test_ambiguous_label(self):
+		self.assertEqual(self.gazetteer.link('how far is mercury'), ([], 0.0))
+
+	def test_save_and_load(self):
+		path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gazetteer.marshal')
+		try:
+			self.gazetteer.save(path)
+			gazetteer = entitylinker.Gazetteer.load(path)
+		finally:
+			if os.path.exists(path):
+				os.remove(path)
+		self.assertEqual(gazetteer.link('population of berlin'), self.gazetteer.link('population of berlin'))
+
+	def test_vocabulary_size(self):
+		shift = entitylinker.SHIFT
+		entitylinker.SHIFT = 2
+		try:
+			self.assertRaises(ValueError, entitylinker.Gazetteer.build, [(u'a b c d', u'A'), (u'e', u'E')])
+		finally:
+			entitylinker.SHIFT = shift
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,58 @@
+# coding=utf-8
+"""Tests of the session tokens of sessions.py.
+
+Run with python -m unittest discover tests, no App Engine SDK is needed.
+"""
+import hashlib
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'asknow-UI'))
+import sessions
+
+KEY = 'a' * 64
+MAX_AGE = 3600
+
+class SessionTokenTest(unittest.TestCase):
+	def test_valid(self):
+		token = sessions.make_token(KEY, 42, u'J\xfcrgen', MAX_AGE)
+		self.assertEqual(sessions.read_token(KEY, token), (42, u'J\xfcrgen'))
+		self.assertEqual(sessions.read_token(KEY, token.decode('utf-8')), (42, u'J\xfcrgen'))
+
+	def test_tampered_signature(self):
+		token = sessions.make_token(KEY, 42, u'jane', MAX_AGE)
+		payload, signature = token.rsplit('|', 1)
+		forged = '%s|%s' % (payload, ('0' if signature[0] != '0' else '1') + signature[1:])
+		self.assertIsNone(sessions.read_token(KEY, forged))
+
+	def test_tampered_payload(self):
+		token = sessions.make_token(KEY, 42, u'jane', MAX_AGE)
+		self.assertIsNone(sessions.read_token(KEY, '43' + token[2:]))
+
+	def test_expired(self):
+		token = sessions.make_token(KEY, 42, u'jane', -1)
+		self.assertIsNone(sessions.read_token(KEY, token))
+		expires = int(time.time()) - 1
+		payload = '42|jane|%s' % expires
+		self.assertIsNone(sessions.read_token(KEY, '%s|%s' % (payload, sessions.sign(KEY, payload))))
+
+	def test_malformed(self):
+		for payload in ('42|jane', 'x|jane|9999999999', '42|jane|soon', '42|\xff|9999999999', '42|a|b|9999999999'):
+			self.assertIsNone(sessions.read_token(KEY, '%s|%s' % (payload, sessions.sign(KEY, payload))))
+		self.assertIsNone(sessions.read_token(KEY, ''))
+		self.assertIsNone(sessions.read_token(KEY, '|||'))
+
+	def test_legacy_cookie(self):
+		# Cookies from before session tokens hold the user id and a hash of
+		# it with a public secret, they are not sessions.
+		cookie = '42|%s' % hashlib.sha256('The AskNow secret42').hexdigest()
+		self.assertIsNone(sessions.read_token(KEY, cookie))
+
+	def test_rotated_key(self):
+		token = sessions.make_token(KEY, 42, u'jane', MAX_AGE)
+		self.assertIsNone(sessions.read_token('b' * 64, token))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,83 @@
+# coding=utf-8
+"""Tests of the circuit breaker, the adaptive deadline and the backoff of
+upstream.py.
+
+Run with python -m unittest discover tests, no App Engine SDK is needed.
+"""
+import os
+import sys
+import time
+import unittest
+
+os.environ.setdefault('ASKNOW_CACHE', 'memory')
+os.environ.setdefault('ASKNOW_FETCH', 'threads')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'asknow-UI'))
+import upstream
+
+class CircuitBreakerTest(unittest.TestCase):
+	def open_breaker(self):
+		breaker = upstream.CircuitBreaker('test', failure_threshold = 2, reset_timeout = 0.05)
+		breaker.record_failure()
+		breaker.record_failure()
+		self.assertEqual(breaker.state, breaker.OPEN)
+		self.assertFalse(breaker.allow())
+		return breaker
+
+	def test_probe_closes(self):
+		breaker = self.open_breaker()
+		time.sleep(0.06)
+		self.assertTrue(breaker.allow())
+		self.assertFalse(breaker.allow())
+		breaker.record_success()
+		self.assertEqual(breaker.state, breaker.CLOSED)
+		self.assertTrue(breaker.allow())
+
+	def test_failed_probe_opens(self):
+		breaker = self.open_breaker()
+		time.sleep(0.06)
+		self.assertTrue(breaker.allow())
+		breaker.record_failure()
+		self.assertEqual(breaker.state, breaker.OPEN)
+		self.assertFalse(breaker.allow())
+
+	def test_abandoned_probe_is_replaced(self):
+		breaker = self.open_breaker()
+		time.sleep(0.06)
+		self.assertTrue(breaker.allow()) # a probe whose result is never recorded
+		self.assertEqual(breaker.state, breaker.HALF_OPEN)
+		self.assertFalse(breaker.allow())
+		time.sleep(0.06)
+		self.assertTrue(breaker.allow())
+		breaker.record_success()
+		self.assertEqual(breaker.state, breaker.CLOSED)
+
+class DeadlineTest(unittest.TestCase):
+	def test_timeouts_raise_the_deadline(self):
+		client = upstream.Upstream('test', deadline = 1, min_deadline = 0.5, max_deadline = 5)
+		for i in range(20):
+			client.record(True, 0.05)
+		self.assertEqual(client.deadline(), 0.5)
+		for i in range(10):
+			deadline = client.deadline()
+			client.record(False, deadline, deadline)
+		self.assertEqual(client.deadline(), 5)
+
+	def test_errors_do_not_change_the_deadline(self):
+		client = upstream.Upstream('test', deadline = 1, min_deadline = 0.1, max_deadline = 5)
+		for i in range(20):
+			client.record(True, 0.2)
+		deadline = client.deadline()
+		client.record(False, 0.01, deadline)
+		self.assertEqual(client.deadline(), deadline)
+
+class BackoffTest(unittest.TestCase):
+	def test_backoff_stops_at_until(self):
+		client = upstream.Upstream('test', backoff = 10)
+		start = time.time()
+		client.sleep_before_retry(1, start + 0.05)
+		self.assertLess(time.time() - start, 0.5)
+		client.sleep_before_retry(1, start - 1)
+		self.assertLess(time.time() - start, 0.5)
+
+if __name__ == '__main__':
+	unittest.main()